@@ -0,0 +1,58 @@
+# 地理信息缓存命中率对比：旧实现（按单个 IP 缓存）与按网段缓存（最长前缀匹配）
+# 用法：python bench/bench_geo_cache.py [连接记录文件] [--mmdb GeoLite2-City.mmdb]
+# 连接记录每行一个远端地址（可带 :端口，如 ss -tn 或 /api/connections 导出的 raddr 列）；
+# 未给出时生成模拟扫描流量：少量 /24 网段内的大量地址，夹杂零散的单个来源
+import os, sys, time, random, ipaddress, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from firewall_web import GeoCache, geo_prefix
+
+def load_trace(path):
+    out = []
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            tok = line.strip().split()
+            if not tok: continue
+            a = tok[-1] if len(tok) > 1 else tok[0]
+            if a.startswith("["): a = a[1:].split("]")[0]
+            elif a.count(":") == 1: a = a.split(":")[0]
+            try: out.append(str(ipaddress.ip_address(a)))
+            except ValueError: pass
+    return out
+
+def gen_trace(n=200000, nets=300, singles=5000):
+    rnd = random.Random(1)
+    subnets = [rnd.randrange(1 << 24, 223 << 24) & ~0xff for _ in range(nets)]
+    lone = [rnd.randrange(1 << 24, 223 << 24) for _ in range(singles)]
+    out = []
+    for _ in range(n):
+        if rnd.random() < 0.85: out.append(str(ipaddress.IPv4Address(rnd.choice(subnets) | rnd.randrange(256))))
+        else: out.append(str(ipaddress.IPv4Address(rnd.choice(lone))))
+    return out
+
+def replay(trace, key_of, maxsize):
+    cache = GeoCache("bench", maxsize=maxsize); t0 = time.perf_counter()
+    for ip in trace:
+        if cache.get(ip) is None: cache.put(key_of(ip), {"text": "", "cc": ""})
+    st = cache.stats(); st["us"] = (time.perf_counter() - t0) / len(trace) * 1e6
+    return st
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("trace", nargs="?"); ap.add_argument("--mmdb"); ap.add_argument("--maxsize", type=int, default=20000)
+    args = ap.parse_args()
+    trace = load_trace(args.trace) if args.trace else gen_trace()
+    print(f"记录 {len(trace)} 条，不同地址 {len(set(trace))} 个，缓存上限 {args.maxsize}")
+    rows = [("按 IP", lambda ip: ip), ("按网段(在线)", geo_prefix)]
+    if args.mmdb:
+        from geoip2.database import Reader
+        reader = Reader(args.mmdb)
+        def mmdb_net(ip):
+            try: return reader.city(ip).traits.network or ip
+            except Exception as e: return getattr(e, "network", None) or ip
+        rows.append(("按网段(MMDB)", mmdb_net))
+    for name, key_of in rows:
+        st = replay(trace, key_of, args.maxsize)
+        print(f"{name:<12} 命中率 {st['hit_ratio']:7.2%}  未命中 {st['misses']:8d}  条目 {st['size']:6d}  淘汰 {st['evictions']:6d}  {st['us']:6.2f} µs/次")
+
+if __name__ == "__main__":
+    main()
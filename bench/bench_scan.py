@@ -0,0 +1,57 @@
+# TCP 扫描耗时对比：旧实现（每 128 个探测 gather 一次，固定超时）与滑动窗口 + 自适应超时的 scan_iter
+# 用法：python bench/bench_scan.py [主机数] [端口数] [超时秒]，默认 8 台 × 256 端口、1 秒
+# 全部在回环地址上进行：127.0.0.x 作为不同主机，部分端口有监听（open），部分为 backlog 已满、
+# 不再应答 SYN 的监听（模拟 filtered，会超时），其余端口直接被拒绝（closed）
+import os, sys, time, socket, asyncio, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import firewall_web as fw
+
+def setup(hosts, ports, rnd):
+    keep = []; kinds = {}
+    for h in hosts:
+        for p in ports:
+            r = rnd.random()
+            if r < 0.10:
+                s = socket.socket(); s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1); s.bind((h, p)); s.listen(128); keep.append(s); kinds[(h, p)] = "open"
+            elif r < 0.13:
+                s = socket.socket(); s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1); s.bind((h, p)); s.listen(0); keep.append(s)
+                for _ in range(3):
+                    c = socket.socket(); c.setblocking(False)
+                    try: c.connect((h, p))
+                    except BlockingIOError: pass
+                    keep.append(c)
+                kinds[(h, p)] = "filtered"
+            else: kinds[(h, p)] = "closed"
+    time.sleep(0.2)
+    return keep, kinds
+
+async def old_scan(hosts, ports, timeout):
+    tasks = [fw.tcp_probe(h, p, timeout=timeout) for h in hosts for p in ports]; results = []
+    for i in range(0, len(tasks), 128):
+        results += await asyncio.gather(*tasks[i:i + 128])
+    return results
+
+async def new_scan(hosts, ports, timeout, concurrency):
+    return [r async for r in fw.scan_iter(fw.scan_jobs("tcp", [(h, h) for h in hosts], ports, timeout), concurrency)]
+
+def check(results, kinds):
+    bad = sum(1 for r in results if (r["open"]) != (kinds[(r["host"], r["port"])] == "open"))
+    return f"open {sum(r['open'] for r in results)}，与预期不符 {bad}"
+
+def main():
+    nh = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    np_ = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    timeout = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    hosts = [f"127.0.0.{i + 2}" for i in range(nh)]; ports = list(range(40000, 40000 + np_))
+    keep, kinds = setup(hosts, ports, random.Random(7))
+    print(f"{nh} 台主机 × {np_} 个端口 = {nh * np_} 个探测，超时 {timeout}s，"
+          f"open {sum(v == 'open' for v in kinds.values())} / filtered {sum(v == 'filtered' for v in kinds.values())}")
+    t0 = time.perf_counter(); res = asyncio.run(old_scan(hosts, ports, timeout))
+    print(f"  旧实现（128 一批）          {time.perf_counter() - t0:7.2f} s  {check(res, kinds)}")
+    for c in (128, 512):
+        t0 = time.perf_counter(); res = asyncio.run(new_scan(hosts, ports, timeout, c))
+        print(f"  滑动窗口 {c:<4} + 自适应超时  {time.perf_counter() - t0:7.2f} s  {check(res, kinds)}")
+    for s in keep: s.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# 套接字枚举耗时对比：psutil.net_connections 与 net_sockets（netlink / /proc 解析，含或不含 PID 归属）
+# 用法：python bench/bench_sockets.py [套接字数 ...]，默认 1000 10000 100000
+# 在本进程内创建绑定到 127.0.0.x 的 UDP 套接字作为负载；文件描述符上限不足的规模会被跳过
+import os, sys, time, socket, resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import psutil
+import firewall_web as fw
+
+def make_sockets(n):
+    out = []; host = 1; port = 20000
+    while len(out) < n:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try: s.bind((f"127.0.0.{host}", port)); out.append(s)
+        except OSError: s.close()
+        port += 1
+        if port > 60000: port = 20000; host += 1
+    return out
+
+def timed(fn, rounds):
+    best = None
+    for _ in range(rounds):
+        t0 = time.perf_counter(); r = fn(); dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best * 1000, len(r)
+
+def run(label, fn, rounds):
+    ms, n = timed(fn, rounds)
+    print(f"  {label:<28} {ms:10.1f} ms  ({n} 条)")
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000]
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError): hard = soft
+    for n in sizes:
+        if n + 256 > hard:
+            print(f"== {n} 个套接字：跳过（文件描述符上限 {hard}）=="); continue
+        socks = make_sockets(n); port = socks[len(socks) // 2].getsockname()[1]
+        rounds = 5 if n <= 10000 else 2
+        print(f"== {n} 个套接字 ==")
+        run("psutil.net_connections", lambda: psutil.net_connections(kind="inet"), rounds)
+        fw._sock_backend["netlink"] = True
+        run("netlink", lambda: fw.net_sockets(pids=False), rounds)
+        run("netlink + PID（缓存失效）", lambda: (setattr(fw.sock_pids, "ts", 0), fw.net_sockets())[1], rounds)
+        run("netlink + PID（缓存命中）", lambda: fw.net_sockets(), rounds)
+        run("netlink 端口过滤", lambda: fw.net_sockets(port=port, pids=False), rounds)
+        fw._sock_backend["netlink"] = False
+        run("/proc/net", lambda: fw.net_sockets(pids=False), rounds)
+        run("/proc/net 端口过滤", lambda: fw.net_sockets(port=port, pids=False), rounds)
+        fw._sock_backend["netlink"] = True
+        for s in socks: s.close()
+
+if __name__ == "__main__":
+    main()
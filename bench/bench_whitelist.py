@@ -0,0 +1,39 @@
+# 白名单准入耗时对比：旧实现（deque 线性扫描）与 WhitelistIndex（有序字典 + 前缀树）
+# 用法：python bench/bench_whitelist.py [条目数 ...]，默认 1000 与 100000
+import os, sys, time, random, ipaddress
+from collections import deque
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from firewall_web import WhitelistIndex
+
+def gen_entries(n, nets=16):
+    rnd = random.Random(n)
+    ips = [str(ipaddress.IPv4Address(rnd.randrange(1 << 24, 223 << 24))) for _ in range(n - nets)]
+    cidrs = [f"{10 + i}.{rnd.randrange(256)}.0.0/16" for i in range(nets)]
+    return ips + cidrs
+
+def bench(fn, probes, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for ip in probes: fn(ip)
+    return (time.perf_counter() - t0) / (rounds * len(probes)) * 1e6
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 100000]
+    for n in sizes:
+        entries = gen_entries(n)
+        old = deque(entries, maxlen=n); new = WhitelistIndex(entries, maxlen=n)
+        hit = entries[-200:-16]; miss = ["203.0.113.%d" % i for i in range(1, 200)]
+        in_net = [e.split("/")[0][:-3] + "%d.%d" % (i, i) for i, e in enumerate(entries[-16:], 1)]
+        # 旧实现只做精确匹配，网段成员只能逐条判断包含关系
+        def old_admit(ip):
+            if ip in old: return True
+            a = ipaddress.ip_address(ip)
+            return any("/" in e and a in ipaddress.ip_network(e) for e in old)
+        rounds = max(1, 20000 // n)
+        print(f"== {n} 条 ==")
+        for name, probes in (("命中IP", hit), ("未命中", miss), ("网段内", in_net)):
+            t_old = bench(old_admit, probes, rounds); t_new = bench(new.covers, probes, rounds * 50)
+            print(f"{name:<6} 旧 {t_old:10.2f} µs  新 {t_new:8.3f} µs  加速 {t_old / t_new:8.0f}x")
+
+if __name__ == "__main__":
+    main()
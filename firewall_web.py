@@ -4,26 +4,39 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.staticfiles import StaticFiles
 
-import os, subprocess, time, json, ipaddress, tempfile, datetime, asyncio, socket, shlex, base64, threading
+import os, subprocess, time, json, ipaddress, tempfile, datetime, asyncio, socket, base64, threading, contextvars, functools, shutil, sqlite3, re, queue, gzip, hashlib, struct, bisect, array, math
 import psutil, requests
-from collections import deque
+from collections import deque, namedtuple, OrderedDict
+try:
+    import numpy as np  # 流量历史的统计与重采样走向量化路径；未安装时退回纯 Python 实现
+except ImportError:
+    np = None
 
 # 使用脚本所在目录作为应用根目录，所有持久化文件均位于此
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 STATE_DIR = os.path.join(APP_DIR, "state")
-STATE_FILE = os.path.join(STATE_DIR, "state.json")
-WHITELIST_FILE = os.path.join(APP_DIR, "whitelist.json")
+STATE_FILE = os.path.join(STATE_DIR, "state.json")      # 旧版 JSON 状态，仅首次启动时迁移
+WHITELIST_FILE = os.path.join(APP_DIR, "whitelist.json")  # 旧版 JSON 白名单，仅首次启动时迁移
+DB_FILE = os.path.join(STATE_DIR, "firewall_web.db")
 LOG_FILE = os.path.join(APP_DIR, "firewall_web.log")
 GEO_MMDB = os.path.join(APP_DIR, "GeoLite2-City.mmdb")
 GEO_MMDB_URL = "https://git.io/GeoLite2-City.mmdb"
+# 下载后必须通过 SHA-256 校验才会启用：优先使用固定的摘要，否则取发布方的 .sha256 文件（sha256sum 格式）；
+# FW_GEO_MMDB_VERIFY=0 时跳过校验（仅在镜像不提供摘要且来源可信时使用）
+GEO_MMDB_SHA256 = os.environ.get("FW_GEO_MMDB_SHA256", "")
+GEO_MMDB_SHA256_URL = os.environ.get("FW_GEO_MMDB_SHA256_URL", GEO_MMDB_URL + ".sha256")
+GEO_MMDB_VERIFY = os.environ.get("FW_GEO_MMDB_VERIFY", "1") != "0"
+GEO_MMDB_BACKOFF_MAX = 6*3600  # 下载/打开失败后的重试间隔按 GEO_MMDB_CHECK 指数增长，最长 6 小时
+GEO_MMDB_MIN = 1024*1024
+GEO_MMDB_CHECK = 60         # 检查数据库文件是否更新的最小间隔（秒）
 DEFAULT_PORT = 48080
-MAX_WL = 1000
+LOG_KEEP = 5  # 日志轮转保留的 gzip 压缩代数
+MAX_WL = 65536  # 白名单默认上限，保存在 settings 表的 wl_max 中，通过 POST /api/wllimit/{n} 调整
 
 COMMON_PORTS = [21,22,23,25,53,67,68,69,80,110,123,137,139,143,161,389,443,465,587,993,995,1433,1521,1723,2049,2379,2380,3000,3128,3306,3389,3478,3690,4000,4040,4369,5000,5432,5601,5672,5900,5984,6379,7001,7070,8000,8008,8080,8081,8088,8090,8443,8500,8778,8888,9000,9042,9090,9092,9200,9418,9999,11211,18080,27017]
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-app.add_middleware(SessionMiddleware, secret_key="change_me_strong", session_cookie="fw_session", same_site="lax", https_only=False, max_age=7*24*3600)
 app.mount("/static", StaticFiles(directory=os.path.join(APP_DIR, "static")), name="static")
 
 USERNAME="admin"
@@ -32,106 +45,447 @@ PASSWORD="admin"
 def ensure_dirs():
     os.makedirs(STATE_DIR, exist_ok=True)
 
-def state_load():
-    ensure_dirs()
+def wl_normalize(x):
+    # 白名单条目可以是单个 IP 或 CIDR 网段，统一为规范写法（单主机不带前缀）；非法返回 None
+    x=(x or "").strip()
+    if x.startswith("::ffff:"): x=x[7:]
+    try: net=ipaddress.ip_network(x, strict=False)
+    except: return None
+    if net.prefixlen==0: return None
+    return str(net.network_address) if net.prefixlen==net.max_prefixlen else str(net)
+
+# ---- SQLite 存储（WAL）：设置、白名单、端口转发与审计日志，变更均为单行写入 ----
+class Store:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS whitelist (id INTEGER PRIMARY KEY AUTOINCREMENT, entry TEXT NOT NULL UNIQUE, added_at REAL NOT NULL, last_seen REAL);
+    CREATE TABLE IF NOT EXISTS forwards (src_port INTEGER PRIMARY KEY, dst_ip TEXT NOT NULL, dst_port INTEGER NOT NULL, created_at REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, user TEXT NOT NULL, ip TEXT NOT NULL, action TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS audit_ts ON audit(ts);
+    CREATE INDEX IF NOT EXISTS audit_user_id ON audit(user, id);
+    CREATE INDEX IF NOT EXISTS audit_ip_id ON audit(ip, id);
+    CREATE INDEX IF NOT EXISTS audit_action ON audit(action);
+    CREATE TABLE IF NOT EXISTS geo_cache (name TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL, negative INTEGER NOT NULL, value TEXT NOT NULL, PRIMARY KEY (name, key));
+    """
+    def __init__(self, path):
+        self.lock = threading.RLock(); self.written = {}  # 已落盘的设置值，只写发生变化的键
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL"); self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def query(self, sql, args=()):
+        with self.lock: return self.db.execute(sql, args).fetchall()
+
+    def write(self, ops):
+        # ops 为 [(sql, 参数)]，在同一事务中提交
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for sql, args in ops: self.db.execute(sql, args)
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK"); raise
+
+    def settings_ops(self, s):
+        ops = []
+        for k, v in list(s.items()):
+            if k == "forwards": continue  # 转发规则单独成表
+            js = json.dumps(v)
+            if self.written.get(k) != js:
+                ops.append(("INSERT OR REPLACE INTO settings(key, value) VALUES(?, ?)", (k, js))); self.written[k] = js
+        return ops
+
+ensure_dirs()
+store = Store(DB_FILE)
+AUDIT_LINE_RE = re.compile(r"^\[(?P<ts>[^\]]+)\] user=(?P<user>\S*) ip=(?P<ip>\S*) action=(?P<action>.*)$")
+
+def store_migrate():
+    # 首次启动时从旧版 JSON 文件与文本日志导入；之后以数据库为准
+    if store.query("PRAGMA user_version")[0][0] >= 1: return
+    ops = []; now = time.time()
+    try:
+        with open(STATE_FILE, "r") as f: old = json.load(f)
+    except: old = {}
+    for f in old.pop("forwards", None) or []:
+        try: ops.append(("INSERT OR REPLACE INTO forwards(src_port, dst_ip, dst_port, created_at) VALUES(?, ?, ?, ?)", (int(f["src_port"]), str(f["dst_ip"]), int(f["dst_port"]), now)))
+        except: pass
+    for k, v in old.items(): ops.append(("INSERT OR REPLACE INTO settings(key, value) VALUES(?, ?)", (k, json.dumps(v))))
+    try:
+        with open(WHITELIST_FILE, "r") as f: arr = json.load(f)
+    except: arr = []
+    for x in arr if isinstance(arr, list) else []:
+        e = wl_normalize(x) if isinstance(x, str) else None
+        if e: ops.append(("INSERT OR IGNORE INTO whitelist(entry, added_at) VALUES(?, ?)", (e, now)))
     try:
-        with open(STATE_FILE,"r") as f: s=json.load(f)
-    except: s={}
+        with open(LOG_FILE, "r", errors="ignore") as f:
+            for line in f:
+                m = AUDIT_LINE_RE.match(line.rstrip("\n"))
+                if not m: continue
+                try: ts = datetime.datetime.strptime(m["ts"], "%Y-%m-%d %H:%M:%S").timestamp()
+                except: continue
+                ops.append(("INSERT INTO audit(ts, user, ip, action) VALUES(?, ?, ?, ?)", (ts, m["user"], m["ip"], m["action"])))
+    except: pass
+    ops.append(("PRAGMA user_version = 1", ()))
+    store.write(ops)
+
+store_migrate()
+
+# ---- 持久化：写操作进入内存队列，后台线程合并后定时在一个事务中提交，不阻塞请求 ----
+PERSIST_INTERVAL = 2.0
+
+class WriteBehind:
+    def __init__(self, interval=PERSIST_INTERVAL):
+        self.interval = interval; self.ops = []; self.dirty = {}; self.lock = threading.Lock()
+        self.io_lock = threading.Lock(); self.wake = threading.Event(); self.thread = None; self.stopped = False
+
+    def op(self, sql, args=()):
+        with self.lock: self.ops.append((sql, args))
+
+    def mark(self, key, build):
+        # build 在刷盘线程中调用，返回要执行的 [(sql, 参数)]；同一 key 多次标记只执行一次
+        with self.lock: self.dirty[key] = build
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="write-behind", daemon=True); self.thread.start()
+
+    def _loop(self):
+        while not self.stopped:
+            self.wake.wait(self.interval); self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock: ops, dirty = self.ops, self.dirty; self.ops, self.dirty = [], {}
+            try:
+                for build in dirty.values(): ops += build()
+                if ops: store.write(ops)
+            except Exception:
+                with self.lock: self.ops[:0] = ops  # 下个周期重试
+
+    def close(self):
+        self.stopped = True; self.wake.set(); self.flush()
+
+persist = WriteBehind()
+
+def state_load():
+    s = {}
+    for k, v in store.query("SELECT key, value FROM settings"):
+        try: s[k] = json.loads(v); store.written[k] = v
+        except: pass
+    s["forwards"] = [{"src_port": sp, "dst_ip": dip, "dst_port": dp} for sp, dip, dp in store.query("SELECT src_port, dst_ip, dst_port FROM forwards ORDER BY created_at, src_port")]
     s.setdefault("panel_port", DEFAULT_PORT)
     s.setdefault("username", USERNAME)
     s.setdefault("password", PASSWORD)
-    s.setdefault("forwards", [])
     s.setdefault("acc_rx", 0); s.setdefault("acc_tx", 0)
-    s.setdefault("last_rx", 0); s.setdefault("last_tx", 0); s.setdefault("last_ts", 0.0)
+    s.setdefault("last_rx", 0); s.setdefault("last_tx", 0)
     s.setdefault("log_max_bytes", 5*1024*1024)
+    s.setdefault("log_keep", LOG_KEEP)
+    s.setdefault("wl_max", MAX_WL)
+    s.setdefault("wl_backend", "ipset")
     return s
 
 def state_save(s):
-    with open(STATE_FILE,"w") as f: json.dump(s,f)
+    persist.mark("settings", lambda: store.settings_ops(s))
 
 state = state_load()
 USERNAME = state.get("username", USERNAME)
 PASSWORD = state.get("password", PASSWORD)
 
-def wl_load():
-    try:
-        with open(WHITELIST_FILE,"r") as f: arr=json.load(f)
-        if isinstance(arr, list): return [x for x in arr if isinstance(x,str)]
-    except: pass
-    return []
-
-def wl_save(arr):
-    with open(WHITELIST_FILE,"w") as f: json.dump(arr[:MAX_WL], f)
-
-whitelist = deque(wl_load(), maxlen=MAX_WL)
-apply_forward_rules()
-<<<<<<< ours
-<<<<<<< ours
-<<<<<<< ours
-=======
+WL_MAX = max(1, int(state.get("wl_max", MAX_WL)))
 
-# 恢复白名单对应的 UFW 规则
-apply_whitelist_rules()
->>>>>>> theirs
-=======
-
-# 恢复白名单对应的 UFW 规则
-apply_whitelist_rules()
->>>>>>> theirs
-=======
+def wl_load():
+    return store.query("SELECT entry, added_at, last_seen FROM whitelist ORDER BY id")
+
+class PrefixTrie:
+    # 按位展开的二叉前缀树，IPv4/IPv6 各一棵；lookup 返回最长匹配的 (前缀长度, 值)
+    # 节点为 [左, 右, 值, 是否为前缀终点]
+    def __init__(self):
+        self.roots = {4: [None, None, None, False], 6: [None, None, None, False]}; self.size = 0
+
+    def insert(self, net, value=True):
+        net = ipaddress.ip_network(net, strict=False); node = self.roots[net.version]
+        bits = int(net.network_address); width = net.max_prefixlen
+        for i in range(net.prefixlen):
+            b = (bits >> (width - 1 - i)) & 1
+            if node[b] is None: node[b] = [None, None, None, False]
+            node = node[b]
+        if not node[3]: self.size += 1
+        node[2] = value; node[3] = True
+
+    def remove(self, net):
+        net = ipaddress.ip_network(net, strict=False); node = self.roots[net.version]
+        bits = int(net.network_address); width = net.max_prefixlen; path = []
+        for i in range(net.prefixlen):
+            b = (bits >> (width - 1 - i)) & 1
+            if node[b] is None: return False
+            path.append((node, b)); node = node[b]
+        if not node[3]: return False
+        node[2] = None; node[3] = False; self.size -= 1
+        # 回收不再承载任何前缀的空分支
+        for parent, b in reversed(path):
+            child = parent[b]
+            if child[0] is None and child[1] is None and not child[3]: parent[b] = None
+            else: break
+        return True
+
+    def lookup(self, addr):
+        if isinstance(addr, str): addr = ipaddress.ip_address(addr)
+        node = self.roots[addr.version]; bits = int(addr); width = addr.max_prefixlen
+        best = (0, node[2]) if node[3] else None
+        for i in range(width):
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None: break
+            if node[3]: best = (i + 1, node[2])
+        return best
+
+class WhitelistIndex:
+    # 保持插入顺序的白名单：条目（值为加入时间）存于有序字典，成员判断 O(1)，满额时 O(1) 淘汰最早条目；
+    # 网段额外登记到前缀树，match() 找出覆盖某个 IP 的条目而无需逐条扫描
+    def __init__(self, entries=(), maxlen=None):
+        self.maxlen = maxlen; self.items = OrderedDict(); self.nets = PrefixTrie()
+        for e in entries: self.append(e)
+
+    def __contains__(self, e): return e in self.items
+    def __iter__(self): return iter(self.items)
+    def __len__(self): return len(self.items)
+
+    def append(self, e, added_at=None):
+        if e in self.items: return None
+        evicted = self.popleft() if self.maxlen and len(self.items) >= self.maxlen else None
+        self.items[e] = added_at or time.time()
+        if "/" in e: self.nets.insert(e, e)
+        return evicted
+
+    def popleft(self):
+        e, _ = self.items.popitem(last=False)
+        if "/" in e: self.nets.remove(e)
+        return e
+
+    def remove(self, e):
+        del self.items[e]
+        if "/" in e: self.nets.remove(e)
+
+    def match(self, ip):
+        if ip in self.items: return ip
+        if not self.nets.size: return None
+        try: hit = self.nets.lookup(ip)
+        except ValueError: return None
+        return hit[1] if hit else None
+
+    def covers(self, ip):
+        return self.match(ip) is not None
+
+WL_SEEN_INTERVAL = 60  # 同一条目的 last_seen 最多每分钟写一次
+whitelist = WhitelistIndex(maxlen=WL_MAX); wl_seen = {}
+
+def wl_add(entries):
+    # 按 FIFO 加入白名单，返回 (新加入, 被挤出) 两个列表，供防火墙后端增量同步
+    added=[]; evicted=[]
+    for e in entries:
+        if e in whitelist: continue
+        old=whitelist.append(e); added.append(e)
+        persist.op("INSERT OR IGNORE INTO whitelist(entry, added_at) VALUES(?, ?)", (e, whitelist.items[e]))
+        if old: evicted.append(old); wl_forget(old)
+    return added, evicted
+
+def wl_forget(e):
+    wl_seen.pop(e, None); persist.op("DELETE FROM whitelist WHERE entry=?", (e,))
+
+def wl_touch(e):
+    now=time.time()
+    if now - wl_seen.get(e, 0) >= WL_SEEN_INTERVAL:
+        wl_seen[e]=now; persist.op("UPDATE whitelist SET last_seen=? WHERE entry=?", (now, e))
 
-# 恢复白名单对应的 UFW 规则
-apply_whitelist_rules()
+for _e, _added, _seen in wl_load():
+    _old = whitelist.append(_e, _added)
+    if _old: wl_forget(_old)  # 数据库中超出上限的旧条目按 FIFO 丢弃
+    if _seen: wl_seen[_e] = _seen
 
 @app.middleware("http")
 async def ip_whitelist_middleware(request: Request, call_next):
     path = request.url.path
     if path.startswith("/static") or path.startswith("/login"):
         return await call_next(request)
-    ip = normalize_ip(request.client.host)
-    if ip in whitelist or request.session.get("logged_in") or check_basic_header(request):
+    ip = normalize_ip(request.client.host); e = whitelist.match(ip)
+    if e: wl_touch(e); return await call_next(request)
+    if request.session.get("logged_in") or check_basic_header(request):
         return await call_next(request)
     return JSONResponse({"detail":"非白名单 IP"}, status_code=403)
->>>>>>> theirs
-
-def rotate_log_if_needed():
-    try:
-        maxb=int(state.get("log_max_bytes",5*1024*1024))
-        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > maxb:
-            os.replace(LOG_FILE, LOG_FILE+".1")
-            open(LOG_FILE,"w").close()
-    except: pass
 
-def log_action(user, client_ip, action):
-    rotate_log_if_needed()
-    now=datetime.datetime.now().strftime("%F %T")
-    with open(LOG_FILE,"a") as f:
-        f.write(f"[{now}] user={user} ip={client_ip} action={action}\n")
+# 会话中间件须在白名单中间件之后注册（后注册者位于外层），否则上面读取 request.session 会失败
+app.add_middleware(SessionMiddleware, secret_key="change_me_strong", session_cookie="fw_session", same_site="lax", https_only=False, max_age=7*24*3600)
 
-def run(cmd):
-    return subprocess.run(cmd, shell=True, capture_output=True, text=True).stdout.strip()
+# ---- 审计日志：有界内存队列 + 单一写线程，文件常开、批量写入文件与数据库 ----
+# 按累计字节数判断轮转，旧日志压缩为 .1.gz ... .N.gz
+AUDIT_QUEUE_MAX = 10000
+AUDIT_BATCH = 500
+
+class AuditWriter:
+    def __init__(self, path):
+        self.path = path; self.q = queue.Queue(maxsize=AUDIT_QUEUE_MAX)
+        self.f = None; self.size = 0; self.dropped = 0; self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="audit-writer", daemon=True); self.thread.start()
+
+    def submit(self, ts, user, ip, action):
+        # 队列满时不阻塞请求，只计数，下一批写入时补记一条丢弃提示
+        try: self.q.put_nowait((ts, user, ip, action))
+        except queue.Full: self.dropped += 1
+
+    def flush(self, timeout=2.0):
+        # 等待此前提交的事件全部落盘（导出日志、修改上限时使用）
+        if self.thread is None: return
+        done = threading.Event()
+        try: self.q.put(done, timeout=timeout); done.wait(timeout)
+        except queue.Full: pass
+
+    def close(self):
+        if self.thread is None: return
+        self.q.put(None); self.thread.join(5); self.thread = None
+
+    def _open(self):
+        self.f = open(self.path, "a", encoding="utf-8"); self.size = self.f.tell()
+
+    def _loop(self):
+        self._open()
+        while True:
+            batch = [self.q.get()]
+            while len(batch) < AUDIT_BATCH:
+                try: batch.append(self.q.get_nowait())
+                except queue.Empty: break
+            stop = None in batch
+            try: self._write([x for x in batch if isinstance(x, tuple)])
+            except Exception: pass
+            for x in batch:
+                if isinstance(x, threading.Event): x.set()
+            if stop:
+                self.f.close(); return
+
+    def _write(self, events):
+        if self.dropped:
+            events.append((time.time(), "-", "-", f"audit queue full, dropped {self.dropped} events")); self.dropped = 0
+        if events:
+            data = "".join(f"[{datetime.datetime.fromtimestamp(ts).strftime('%F %T')}] user={u} ip={ip} action={a}\n" for ts, u, ip, a in events)
+            self.f.write(data); self.f.flush(); self.size += len(data.encode())
+            try: store.write([("INSERT INTO audit(ts, user, ip, action) VALUES(?, ?, ?, ?)", ev) for ev in events])
+            except Exception: pass
+        if self.size > int(state.get("log_max_bytes", 5*1024*1024)): self._rotate()
+
+    def _rotate(self):
+        keep = max(1, int(state.get("log_keep", LOG_KEEP)))
+        self.f.close()
+        try:
+            for i in range(keep - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}.gz"): os.replace(f"{self.path}.{i}.gz", f"{self.path}.{i+1}.gz")
+            with open(self.path, "rb") as src, gzip.open(self.path + ".1.gz.tmp", "wb") as dst: shutil.copyfileobj(src, dst)
+            os.replace(self.path + ".1.gz.tmp", self.path + ".1.gz")
+            open(self.path, "w").close()
+            for i in range(keep + 1, keep + 100):
+                if not os.path.exists(f"{self.path}.{i}.gz"): break
+                os.remove(f"{self.path}.{i}.gz")  # 调小保留代数后清理多余的旧文件
+        finally:
+            self._open()
 
-def ufw_enabled():
-    out = run("ufw status")
-    return "Status: active" in out
+audit_log = AuditWriter(LOG_FILE)
 
-def ufw_enable():
-    subprocess.run("yes | ufw enable", shell=True)
+def log_action(user, client_ip, action):
+    audit_log.submit(time.time(), str(user), str(client_ip), str(action))
+
+# ---- 命令执行层：argv 方式异步执行（无 shell），限制并发、单条超时并记录耗时 ----
+CMD_CONCURRENCY = 8
+CMD_TIMEOUT = 30.0
+CmdResult = namedtuple("CmdResult", "argv rc out err ms timed_out")
+
+class CmdRunner:
+    def __init__(self, limit=CMD_CONCURRENCY):
+        self.limit = limit; self.loop = None; self.sem = None; self.queue = None; self.worker = None
+        self.recent = deque(maxlen=200); self.stats = {}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.sem = asyncio.Semaphore(self.limit); self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._mutation_worker())
+
+    async def exec(self, argv, input=None, timeout=CMD_TIMEOUT):
+        argv = [str(a) for a in argv]
+        async with self.sem:
+            t0 = time.monotonic(); timed_out = False
+            try:
+                proc = await asyncio.create_subprocess_exec(*argv, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                try:
+                    out, err = await asyncio.wait_for(proc.communicate(input.encode() if input is not None else None), timeout)
+                    rc = proc.returncode
+                except asyncio.TimeoutError:
+                    timed_out = True; proc.kill(); await proc.communicate(); out, err, rc = b"", b"timeout", -9
+            except OSError as e:
+                out, err, rc = b"", str(e).encode(), 127
+            res = CmdResult(argv, rc, out.decode(errors="ignore"), err.decode(errors="ignore"), round((time.monotonic()-t0)*1000, 1), timed_out)
+        self._record(res)
+        return res
+
+    def _record(self, res):
+        self.recent.append({"argv": res.argv, "rc": res.rc, "ms": res.ms, "timed_out": res.timed_out, "ts": time.time()})
+        st = self.stats.setdefault(res.argv[0], {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "failed": 0, "timeouts": 0})
+        st["count"] += 1; st["total_ms"] = round(st["total_ms"] + res.ms, 1); st["max_ms"] = max(st["max_ms"], res.ms)
+        st["failed"] += res.rc != 0; st["timeouts"] += res.timed_out
+
+    async def mutate(self, fn, *args, **kwargs):
+        # 所有防火墙变更经同一队列串行执行，避免并发修改交错导致规则编号错位
+        fut = self.loop.create_future()
+        await self.queue.put((fn, args, kwargs, fut))
+        return await fut
+
+    async def _mutation_worker(self):
+        _in_fw_queue.set(True)
+        while True:
+            fn, args, kwargs, fut = await self.queue.get()
+            try: res = await fn(*args, **kwargs)
+            except Exception as e:
+                if not fut.done(): fut.set_exception(e)
+            else:
+                if not fut.done(): fut.set_result(res)
+
+cmd_runner = CmdRunner()
+_in_fw_queue = contextvars.ContextVar("in_fw_queue", default=False)
+
+def fw_serial(fn):
+    # 变更入口统一排队；已在队列任务内部时直接执行，避免嵌套调用自我等待
+    async def wrapper(*args, **kwargs):
+        if _in_fw_queue.get() or cmd_runner.loop is None: return await fn(*args, **kwargs)
+        return await cmd_runner.mutate(fn, *args, **kwargs)
+    return functools.wraps(fn)(wrapper)
+
+def spawn(fn, *args):
+    # 供同步代码（含线程池中的接口）把协程提交到应用事件循环，不等待结果；循环未启动时返回 False
+    loop = cmd_runner.loop
+    if loop is None: return False
+    try: running = asyncio.get_running_loop()
+    except RuntimeError: running = None
+    if running is loop: loop.create_task(fn(*args))
+    else: asyncio.run_coroutine_threadsafe(fn(*args), loop)
+    return True
+
+async def run(argv, input=None, timeout=CMD_TIMEOUT):
+    return (await cmd_runner.exec(argv, input=input, timeout=timeout)).out.strip()
+
+async def ufw_enabled():
+    return "Status: active" in await run(["ufw", "status"])
+
+@fw_serial
+async def ufw_enable():
+    await run(["ufw", "--force", "enable"]); ufw_model_invalidate()
 
 def ufw_status_numbered():
-    return run("ufw status numbered")
-
-def ufw_allow_anywhere(port):
-    subprocess.run(f"ufw allow {int(port)}/tcp comment 'fw-web-panel'", shell=True)
+    return "\n".join(ufw_model()["lines"])
 
-def ufw_allow_from_ip_any(ip):
-    subprocess.run(f"ufw insert 1 allow from {ip} to any", shell=True)
-
-def ufw_allow_from_ip_port(ip, port):
-    subprocess.run(f"ufw insert 1 allow from {ip} to any port {int(port)}", shell=True)
-
-def ufw_delete_rule_number(num):
-    subprocess.run(f"yes | ufw delete {int(num)}", shell=True)
+@fw_serial
+async def ufw_allow_anywhere(port):
+    await run(["ufw", "allow", f"{int(port)}/tcp", "comment", "fw-web-panel"])
+    ufw_model_invalidate()
 
 def normalize_ip(ip):
     if not ip: return ip
@@ -139,40 +493,298 @@ def normalize_ip(ip):
     if "%" in ip: return ip.split("%",1)[0]
     return ip
 
-def apply_forward_rules():
+# ---- 规则引擎：计算期望规则集，与现有规则做差异，一次性写入 ----
+# UFW 的规则以 "### tuple ###" 块的形式保存在 user.rules / user6.rules 中，
+# 直接重写规则文件后只需一次 ufw reload，替代逐条 ufw insert（每条都会整体重载）
+UFW_USER_RULES = {False: "/etc/ufw/user.rules", True: "/etc/ufw/user6.rules"}
+WL_TAG = "fw-web-wl"; OPEN_TAG = "fw-web-open"; FWD_TAG = "fw-web-forward"; ACCT_TAG = "fw-web-acct"
+UfwRule = namedtuple("UfwRule", "action proto dport dst sport src direction comment v6")
+UFW_TARGETS = {"allow": "ACCEPT", "deny": "DROP", "reject": "REJECT"}
+
+def ufw_addr(x):
+    # 与 ufw 一致：单主机去掉 /32、/128 前缀
+    net = ipaddress.ip_network(x, strict=False)
+    return str(net.network_address) if net.prefixlen == net.max_prefixlen else str(net)
+
+def ufw_port_ok(p):
+    # 端口为 any、单个端口或 lo:hi 范围，均须在 1..65535 内
+    if str(p) == "any": return True
+    try: nums = [int(x) for x in str(p).split(":")]
+    except ValueError: return False
+    return len(nums) <= 2 and all(1 <= n <= 65535 for n in nums) and nums == sorted(nums)
+
+def ufw_rule(action="allow", proto="any", dport="any", dst="", sport="any", src="", comment=""):
+    # 规则直接写入 user.rules，非法端口会使之后的 ufw reload / enable 全部失败，必须在此拦截
+    if not (ufw_port_ok(dport) and ufw_port_ok(sport)): raise ValueError(f"invalid port {dport} / {sport}")
+    src = ufw_addr(src) if src else ""; dst = ufw_addr(dst) if dst else ""
+    v6 = ":" in src or ":" in dst
+    anyaddr = "::/0" if v6 else "0.0.0.0/0"
+    return UfwRule(action, proto, str(dport), dst or anyaddr, str(sport), src or anyaddr, "in", comment, v6)
+
+def ufw_key(r):
+    return r._replace(comment="")
+
+def ufw_rule_lines(r):
+    chain = ("ufw6" if r.v6 else "ufw") + "-user-" + ("forward" if r.action.startswith("route:") else "input")
+    spec = ""
+    if r.dst not in ("0.0.0.0/0", "::/0"): spec += " -d " + r.dst
+    if r.dport != "any": spec += " --dport " + r.dport
+    if r.src not in ("0.0.0.0/0", "::/0"): spec += " -s " + r.src
+    if r.sport != "any": spec += " --sport " + r.sport
+    if r.proto != "any": protos = [r.proto]
+    elif r.dport != "any" or r.sport != "any": protos = ["tcp", "udp"]
+    else: protos = [""]
+    tup = "### tuple ### %s %s %s %s %s %s %s" % tuple(r[:7])
+    if r.comment: tup += " comment=" + r.comment.encode().hex()
+    target = UFW_TARGETS.get(r.action.split(":")[-1], "ACCEPT")
+    return [tup] + [f"-A {chain}{' -p '+p if p else ''}{spec} -j {target}" for p in protos]
+
+def ufw_parse_tuple(line, v6):
+    f = line[len("### tuple ###"):].split(); comment = ""
+    if f and f[-1].startswith("comment="):
+        try: comment = bytes.fromhex(f.pop()[8:]).decode("utf-8", "ignore")
+        except: comment = ""
+    if len(f) == 9: f = f[:6] + f[8:]  # 应用规则（dapp/sapp）
+    if len(f) != 7: return None
+    return UfwRule(*f, comment, v6)
+
+def ufw_rules_read(v6):
     try:
-        for l in run("iptables -t nat -S PREROUTING").splitlines():
-            if "fw-web-forward" in l:
-                subprocess.run("iptables -t nat " + l.replace("-A","-D",1), shell=True)
-        for l in run("iptables -t nat -S POSTROUTING").splitlines():
-            if "fw-web-forward" in l:
-                subprocess.run("iptables -t nat " + l.replace("-A","-D",1), shell=True)
-    except: pass
-    try:
-        for line in run("ufw status numbered").splitlines():
-            if "]" in line and "fw-web-forward" in line:
-                try:
-                    num=int(line.split("]")[0].strip("[ "))
-                    ufw_delete_rule_number(num)
-                except: pass
-    except: pass
-    for f in state.get("forwards", []):
+        with open(UFW_USER_RULES[v6], "r") as f: lines = f.read().split("\n")
+        i = lines.index("### RULES ###"); j = lines.index("### END RULES ###")
+    except: return None
+    blocks = []; cur = None
+    for l in lines[i+1:j]:
+        if l.startswith("### tuple ###"): cur = [l]; blocks.append(cur)
+        elif not l.strip(): cur = None
+        elif cur is not None: cur.append(l)
+        else: blocks.append([l])
+    return lines[:i+1], blocks, lines[j:]
+
+def ufw_rules_write(v6, head, blocks, tail):
+    path = UFW_USER_RULES[v6]; body = []
+    for b in blocks: body += [""] + b
+    tmp = path + ".fw-web.tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(head + body + [""] + tail)); f.flush(); os.fsync(f.fileno())
+    os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp, path)
+
+def _ufw_rewrite(want, scope, drop):
+    added = removed = 0; changed = False; error = None
+    for v6 in (False, True):
+        parsed = ufw_rules_read(v6)
+        if parsed is None: continue
+        head, blocks, tail = parsed
+        wanted = {ufw_key(r): r for r in want if r.v6 == v6}
+        have = set(); keep = []
+        for b in blocks:
+            r = ufw_parse_tuple(b[0], v6) if b[0].startswith("### tuple ###") else None
+            if r and ((r.comment in scope and ufw_key(r) not in wanted) or (drop and drop(r))):
+                removed += 1; continue
+            if r: have.add(ufw_key(r))
+            keep.append(b)
+        new = [r for k, r in wanted.items() if k not in have]
+        if not new and len(keep) == len(blocks): continue
+        # 与 ufw insert 1 / ufw route allow 的位置保持一致：普通规则置顶，转发规则追加
+        top = [ufw_rule_lines(r) for r in new if not r.action.startswith("route:")]
+        end = [ufw_rule_lines(r) for r in new if r.action.startswith("route:")]
+        try:
+            ufw_rules_write(v6, head, top + keep + end, tail); changed = True; added += len(new)
+        except Exception as e:
+            error = f"{UFW_USER_RULES[v6]}: {e}"; removed -= len(blocks) - len(keep)
+    return added, removed, changed, error
+
+@fw_serial
+async def ufw_apply(want=(), scope=(), drop=None):
+    # want：期望存在的规则；scope：由本程序管理的注释标签，带这些标签但不在 want 中的规则会被移除
+    # drop：额外的删除条件，命中的规则在同一次重写中一并移除
+    t0 = time.time()
+    added, removed, changed, error = await asyncio.to_thread(_ufw_rewrite, list(want), scope, drop)
+    if changed:
+        rl = await cmd_runner.exec(["ufw", "reload"]); ufw_model_invalidate()
+        if rl.rc != 0: error = error or f"ufw reload: {(rl.err or rl.out).strip() or rl.rc}"
+        if WL_IPSET: await ipset_hook()
+    res = {"added": added, "removed": removed, "ms": round((time.time()-t0)*1000, 1)}
+    if error: res["error"] = error
+    return res
+
+async def ufw_delete_where(*preds):
+    # 批量删除：所有命中任一条件的规则在一次规则文件重写 + 一次 reload 中删除
+    res = await ufw_apply(drop=lambda r: any(p(r) for p in preds))
+    return {k: res[k] for k in ("removed", "ms", "error") if k in res}
+
+@fw_serial
+async def ipt_apply(table, want, tag):
+    # 一次 iptables -S 读取现有规则，差异通过一次 iptables-restore --noflush 原子提交
+    live = [l for l in (await run(["iptables", "-t", table, "-S"])).splitlines() if tag in l]
+    norm = lambda l: " ".join(l.split())
+    ws = {norm(l) for l in want}; ls = {norm(l) for l in live}
+    stale = [l for l in live if norm(l) not in ws]
+    new = [l for l in dict.fromkeys(want) if norm(l) not in ls]
+    if stale or new:
+        payload = f"*{table}\n" + "".join("-D" + l[2:] + "\n" for l in stale) + "".join(l + "\n" for l in new) + "COMMIT\n"
+        res = await cmd_runner.exec(["iptables-restore", "--noflush"], input=payload)
+        # restore 是整体事务，任一行出错则全部未生效
+        if res.rc != 0: return {"added": 0, "removed": 0, "error": res.err.strip() or f"iptables-restore rc={res.rc}"}
+    return {"added": len(new), "removed": len(stale)}
+
+# ---- UFW 规则模型：解析规则文件得到结构化规则，按文件签名缓存 ----
+# 与 ufw status numbered 的编号一致：先 IPv4 规则，再 IPv6 规则
+UFW_CONF = "/etc/ufw/ufw.conf"
+_ufw_cache = {"sig": None, "model": None}; _ufw_cache_lock = threading.Lock()
+
+def ufw_model_invalidate():
+    _ufw_cache["sig"] = None
+
+def _ufw_files_sig():
+    sig = []
+    for path in (UFW_USER_RULES[False], UFW_USER_RULES[True], UFW_CONF):
+        try: st = os.stat(path); sig.append((st.st_mtime_ns, st.st_size))
+        except: sig.append(None)
+    return tuple(sig)
+
+def ufw_is_any(addr):
+    return addr in ("0.0.0.0/0", "::/0")
+
+def ufw_port_match(spec, port):
+    # 精确匹配端口，支持 80,443 与 8000:8010 这类多端口/范围写法；避免 "80" 误中 "8080"
+    for part in str(spec).split(","):
+        a, _, b = part.partition(":")
         try:
-            sp=int(f.get("src_port")); dip=f.get("dst_ip"); dp=int(f.get("dst_port"))
-            subprocess.run(f"iptables -t nat -A PREROUTING -p tcp --dport {sp} -j DNAT --to-destination {dip}:{dp} -m comment --comment fw-web-forward", shell=True)
-            subprocess.run(f"iptables -t nat -A POSTROUTING -p tcp -d {dip} --dport {dp} -j MASQUERADE -m comment --comment fw-web-forward", shell=True)
-            subprocess.run(f"ufw route allow proto tcp from any to {dip} port {dp} comment 'fw-web-forward'", shell=True)
+            if int(a) <= int(port) <= int(b or a): return True
         except: pass
+    return False
 
-def apply_whitelist_rules():
-    # 还原白名单对应的「全端口放行」
-    for ip in list(whitelist):
-        ufw_allow_from_ip_any(ip)
+def ufw_rule_text(r):
+    def side(addr, port, proto):
+        s = "" if ufw_is_any(addr) else addr
+        if port != "any": s += (" " if s else "") + port + ("" if proto == "any" else "/" + proto)
+        return (s or "Anywhere") + (" (v6)" if r.v6 and ufw_is_any(addr) else "")
+    route = r.action.startswith("route:")
+    action = r.action.split(":")[-1].upper() + " " + ("FWD" if route else r.direction.split("_")[0].upper())
+    return side(r.dst, r.dport, r.proto), action, side(r.src, r.sport, r.proto)
+
+def ufw_rule_json(num, r):
+    to, action, frm = ufw_rule_text(r)
+    return {"num": num, "action": r.action.split(":")[-1], "route": r.action.startswith("route:"), "direction": r.direction,
+            "from": r.src, "to": r.dst, "port": r.dport, "sport": r.sport, "proto": r.proto, "comment": r.comment, "v6": r.v6,
+            "text": f"[{num:2d}] {to:<26} {action:<12}{frm}" + (f"  # {r.comment}" if r.comment else "")}
+
+def ufw_model():
+    sig = _ufw_files_sig(); m = _ufw_cache["model"]
+    if m is not None and _ufw_cache["sig"] == sig: return m
+    with _ufw_cache_lock:
+        rules = []
+        for v6 in (False, True):
+            parsed = ufw_rules_read(v6)
+            if parsed is None: continue
+            for b in parsed[1]:
+                r = ufw_parse_tuple(b[0], v6) if b[0].startswith("### tuple ###") else None
+                if r: rules.append(r)
+        enabled = False
+        try:
+            with open(UFW_CONF, "r") as f: enabled = any(l.strip().lower() == "enabled=yes" for l in f)
+        except: pass
+        items = [ufw_rule_json(i, r) for i, r in enumerate(rules, 1)]
+        m = {"enabled": enabled, "rules": rules, "items": items, "lines": [x["text"] for x in items]}
+        _ufw_cache["model"] = m; _ufw_cache["sig"] = sig
+        return m
 
-# 初始化防火墙规则，确保面板端口对所有 IP 放行
-ufw_allow_anywhere(state.get("panel_port", DEFAULT_PORT))
-apply_forward_rules()
-apply_whitelist_rules()
+def ufw_allow_in(r):
+    return r.action == "allow" and r.direction.startswith("in")
+
+def forward_targets():
+    out = []
+    for f in state.get("forwards", []):
+        try: out.append((int(f.get("src_port")), str(ipaddress.ip_address(f.get("dst_ip"))), int(f.get("dst_port"))))
+        except: pass
+    return out
+
+@fw_serial
+async def apply_forward_rules():
+    # 仅支持 IPv4 目标（NAT 规则经 iptables-restore 提交）；旧数据中的 IPv6 目标跳过，避免整个事务失败
+    nat = []; targets = [t for t in forward_targets() if ":" not in t[1]]
+    for sp, dip, dp in targets:
+        # 使用 iptables -S 的规范输出格式，便于与现有规则逐行比较
+        nat.append(f"-A PREROUTING -p tcp -m tcp --dport {sp} -m comment --comment {FWD_TAG} -j DNAT --to-destination {dip}:{dp}")
+        nat.append(f"-A POSTROUTING -d {dip}/32 -p tcp -m tcp --dport {dp} -m comment --comment {FWD_TAG} -j MASQUERADE")
+    nres = await ipt_apply("nat", nat, FWD_TAG)
+    res = await ufw_apply([ufw_rule("route:allow", "tcp", dp, dip, comment=FWD_TAG) for sp, dip, dp in targets], scope=(FWD_TAG,))
+    if "error" in nres: res["error"] = nres["error"] + ("; " + res["error"] if "error" in res else "")
+    return res
+
+@fw_serial
+async def apply_whitelist_rules():
+    # 还原白名单对应的「全端口放行」，并移除已不在白名单中的旧规则
+    if WL_IPSET and await ipset_reload():
+        # ipset 模式下不再需要逐 IP 的 UFW 规则，清理之前遗留的 fw-web-wl 规则
+        return await ufw_apply([], scope=(WL_TAG,))
+    return await ufw_apply([ufw_rule(src=ip, comment=WL_TAG) for ip in whitelist], scope=(WL_TAG,))
+
+# ---- ipset 白名单后端：条目放在内核 hash:net 集合中，由一条 iptables 规则引用 ----
+# 内核按哈希匹配，条目数不再影响每个包的匹配开销；不可用时退回逐条 UFW 规则
+IPSET_NAMES = {False: "fw-web-wl", True: "fw-web-wl6"}
+WL_IPSET = state.get("wl_backend") == "ipset" and shutil.which("ipset") is not None
+
+def ipset_name(e):
+    return IPSET_NAMES[":" in e]
+
+async def ipset_hook():
+    # INPUT 链首的引用规则；ufw reload 后重新确认一次
+    for v6, name in IPSET_NAMES.items():
+        ipt = "ip6tables" if v6 else "iptables"
+        spec = ["-m", "set", "--match-set", name, "src", "-m", "comment", "--comment", WL_TAG, "-j", "ACCEPT"]
+        if (await cmd_runner.exec([ipt, "-C", "INPUT", *spec])).rc != 0:
+            await cmd_runner.exec([ipt, "-I", "INPUT", "1", *spec])
+            # 计数跳转须排在放行规则之前，否则白名单流量在 ACCEPT 处终止而不被统计
+            if acct.installed[6 if v6 else 4] is not None: await acct_hook(6 if v6 else 4)
+
+@fw_serial
+async def ipset_reload():
+    # 整体重建：先填充临时集合，再 ipset swap 原子替换，替换过程中匹配不中断。
+    # 临时集合总是按当前参数新建，swap 后现有集合即带上新的 maxelem（wl_max 调整后无需手工处理）；
+    # 现有集合只在不存在时创建，避免 create 与已有集合的参数不一致而使整个 restore 失败
+    have = set((await cmd_runner.exec(["ipset", "list", "-n"])).out.split()); lines = []
+    for v6, name in IPSET_NAMES.items():
+        tmp = name + "-tmp"; opts = f"hash:net family {'inet6' if v6 else 'inet'} maxelem {WL_MAX}"
+        if name not in have: lines.append(f"create {name} {opts}")
+        if tmp in have: lines.append(f"destroy {tmp}")
+        lines.append(f"create {tmp} {opts}")
+        lines += [f"add {tmp} {e}" for e in whitelist if (":" in e) == v6]
+        lines += [f"swap {tmp} {name}", f"destroy {tmp}"]
+    res = await cmd_runner.exec(["ipset", "-exist", "restore"], input="\n".join(lines) + "\n")
+    if res.rc != 0:
+        log_action("system", "-", f"ipset restore failed, falling back to per-entry ufw rules: {res.err.strip()[:200]}")
+        return False
+    await ipset_hook()
+    return True
+
+@fw_serial
+async def ipset_update(added=(), removed=()):
+    lines = [f"add {ipset_name(e)} {e}" for e in added] + [f"del {ipset_name(e)} {e}" for e in removed]
+    if not lines: return True
+    return (await cmd_runner.exec(["ipset", "-exist", "restore"], input="\n".join(lines) + "\n")).rc == 0
+
+async def wl_apply_change(added=(), removed=()):
+    # 增量同步：ipset 模式只增删变化的条目，否则对 UFW 规则做一次差异同步
+    if WL_IPSET and await ipset_update(added, removed): return
+    await apply_whitelist_rules()
+
+@app.on_event("startup")
+async def fw_startup():
+    persist.start(); audit_log.start()
+    await cmd_runner.start()
+    # 初始化防火墙规则，确保面板端口对所有 IP 放行
+    await ufw_allow_anywhere(state.get("panel_port", DEFAULT_PORT))
+    await apply_forward_rules()
+    await apply_whitelist_rules()
+    geo_db.refresh()
+    conn_snap.start(); traffic_hist.start(); acct.start()
+
+@app.on_event("shutdown")
+def persist_shutdown():
+    audit_log.close(); persist.close()
 
 # ---- Auth helpers ----
 def check_basic_header(request: Request):
@@ -186,11 +798,9 @@ def check_basic_header(request: Request):
             ip=normalize_ip(request.client.host)
             try:
                 ipaddress.ip_address(ip)
-                if ip not in whitelist:
-                    if len(whitelist) >= MAX_WL:
-                        whitelist.popleft()
-                    whitelist.append(ip); wl_save(list(whitelist))
-                    ufw_allow_from_ip_any(ip)
+                if not whitelist.covers(ip):
+                    added, evicted = wl_add([ip])
+                    spawn(wl_apply_change, added, evicted)
             except: pass
             return True
     except: pass
@@ -215,6 +825,7 @@ def current_user(request: Request):
 def audit(action):
     def decorator(func):
         if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
             async def wrapper(*args, **kwargs):
                 request=kwargs.get("request")
                 if request is None:
@@ -227,6 +838,7 @@ def audit(action):
                 return await func(*args, **kwargs)
             return wrapper
         else:
+            @functools.wraps(func)
             def wrapper(*args, **kwargs):
                 request=kwargs.get("request")
                 if request is None:
@@ -241,62 +853,303 @@ def audit(action):
     return decorator
 
 # ---- Geo helpers ----
-_geo_reader=None; geo_cache_local={}; geo_cache_online={}
-def _ensure_mmdb():
-    if not os.path.exists(GEO_MMDB):
+GEO_CACHE_MAX = 20000
+GEO_TTL = 7*86400          # 成功结果的有效期
+GEO_NEG_TTL = 600          # 失败/未知结果的有效期，过期后重新查询
+GEO_PREFIX4 = int(os.environ.get("FW_GEO_PREFIX4", 24))   # 在线结果按网段缓存的前缀长度
+GEO_PREFIX6 = int(os.environ.get("FW_GEO_PREFIX6", 48))
+
+def geo_prefix(ip):
+    a = ipaddress.ip_address(ip)
+    return str(ipaddress.ip_network(f"{a}/{GEO_PREFIX4 if a.version == 4 else GEO_PREFIX6}", strict=False))
+
+class GeoCache:
+    # 有界 LRU 缓存，以网段为键：get(ip) 经前缀树做最长前缀匹配，同一网段内的地址共用一条结果；
+    # 成功与失败结果分别设置 TTL，统计命中/未命中/过期/淘汰次数；
+    # persist=True 时每次变更作为单行写入数据库，重启后载入，避免重启后集中重新查询
+    def __init__(self, name, maxsize=GEO_CACHE_MAX, ttl=GEO_TTL, neg_ttl=GEO_NEG_TTL, persist=False):
+        self.name = name; self.maxsize = maxsize; self.ttl = ttl; self.neg_ttl = neg_ttl; self.persist = persist
+        self.data = OrderedDict(); self.trie = PrefixTrie(); self.lock = threading.Lock()
+        self.hits = self.misses = self.expired = self.evictions = 0
+
+    def get(self, ip):
+        with self.lock:
+            try: hit = self.trie.lookup(ip)
+            except ValueError: hit = None
+            if hit is None: self.misses += 1; return None
+            key = hit[1]; item = self.data[key]
+            if item[0] < time.time():
+                self._drop(key); self.expired += 1; self.misses += 1; return None
+            self.data.move_to_end(key); self.hits += 1
+            return item[2]
+
+    def _drop(self, key):
+        del self.data[key]; self.trie.remove(key)
+
+    def put(self, net, value, negative=False):
+        # net 为网段（如 MMDB 记录所在网络）或单个地址
+        key = str(ipaddress.ip_network(net, strict=False))
+        expires = time.time() + (self.neg_ttl if negative else self.ttl); evicted = []
+        with self.lock:
+            if key not in self.data: self.trie.insert(key, key)
+            self.data[key] = (expires, negative, value); self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                k = next(iter(self.data)); self._drop(k); evicted.append(k); self.evictions += 1
+        if self.persist:
+            persist.op("INSERT OR REPLACE INTO geo_cache(name, key, expires, negative, value) VALUES(?, ?, ?, ?, ?)",
+                       (self.name, key, expires, int(negative), json.dumps(value, ensure_ascii=False)))
+            for k in evicted: persist.op("DELETE FROM geo_cache WHERE name=? AND key=?", (self.name, k))
+        return value
+
+    def load(self):
+        now = time.time()
+        persist.op("DELETE FROM geo_cache WHERE name=? AND expires<?", (self.name, now))
+        rows = store.query("SELECT key, expires, negative, value FROM geo_cache WHERE name=? AND expires>=? ORDER BY expires DESC LIMIT ?", (self.name, now, self.maxsize))
+        with self.lock:
+            for key, expires, negative, value in reversed(rows):
+                try:
+                    key = str(ipaddress.ip_network(key, strict=False))   # 兼容旧版按单个 IP 保存的键
+                    if key not in self.data: self.trie.insert(key, key)
+                    self.data[key] = (expires, bool(negative), json.loads(value))
+                except: pass
+
+    def clear(self):
+        with self.lock: self.data.clear(); self.trie = PrefixTrie()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self.data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses, "expired": self.expired,
+                "evictions": self.evictions, "hit_ratio": round(self.hits / total, 4) if total else None}
+
+geo_cache_local = GeoCache("local", ttl=86400, neg_ttl=86400)
+geo_cache_online = GeoCache("online", persist=True)
+geo_cache_online.load()
+
+class GeoDB:
+    # 本地 GeoLite2 库：后台流式下载（校验大小与 SHA-256）后以内存映射方式打开；
+    # 文件变化时在后台打开新库并原子替换，替换完成前查询继续使用旧库，请求线程从不等待下载或打开
+    def __init__(self, path, url):
+        self.path = path; self.url = url; self.reader = None; self.sig = None
+        self.lock = threading.Lock(); self.busy = False; self.checked = -GEO_MMDB_CHECK
+        self.loads = self.downloads = 0; self.error = ""; self.fails = 0; self.retry_at = 0
+
+    def _sig(self):
+        try: st = os.stat(self.path); return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError: return None
+
+    def get(self):
+        now = time.monotonic()
+        if now - self.checked >= GEO_MMDB_CHECK and now >= self.retry_at:
+            self.checked = now
+            if self.reader is None or self._sig() != self.sig: self.refresh()
+        return self.reader
+
+    def refresh(self):
+        with self.lock:
+            if self.busy: return
+            self.busy = True
+        threading.Thread(target=self._work, name="geo-db", daemon=True).start()
+
+    def _work(self):
         try:
-            r=requests.get(GEO_MMDB_URL, timeout=10)
-            if r.status_code==200 and len(r.content)>1024*1024:
-                with open(GEO_MMDB,"wb") as f: f.write(r.content)
-        except: pass
-def _geo_reader_init():
-    global _geo_reader
-    if _geo_reader is None:
-        _ensure_mmdb()
-        if os.path.exists(GEO_MMDB):
-            try:
-                from geoip2.database import Reader
-                _geo_reader=Reader(GEO_MMDB)
-            except: _geo_reader=None
+            if not os.path.exists(self.path): self._download()
+            sig = self._sig()
+            if sig is not None and sig != self.sig:
+                reader = self._open(self.path)
+                # 旧 Reader 不主动关闭：仍在使用它的查询结束后由引用计数释放映射
+                self.reader, self.sig = reader, sig; self.loads += 1
+                geo_cache_local.clear()
+            self.fails = 0; self.retry_at = 0
+        except Exception as e:
+            self.error = str(e); self.fails += 1
+            self.retry_at = time.monotonic() + min(GEO_MMDB_CHECK * 2 ** (self.fails - 1), GEO_MMDB_BACKOFF_MAX)
+        finally:
+            with self.lock: self.busy = False
+
+    def _open(self, path):
+        from geoip2.database import Reader
+        try: from maxminddb import MODE_MMAP
+        except ImportError: MODE_MMAP = 0
+        return Reader(path, mode=MODE_MMAP)
+
+    def _download(self):
+        digest = self._digest() if GEO_MMDB_VERIFY else None  # 先取摘要，取不到则不下载整个库
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".mmdb-")
+        try:
+            h = hashlib.sha256(); size = 0
+            with os.fdopen(fd, "wb") as f, requests.get(self.url, stream=True, timeout=(10, 60)) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(1 << 16):
+                    f.write(chunk); h.update(chunk); size += len(chunk)
+                f.flush(); os.fsync(f.fileno())
+            expect = int(r.headers.get("Content-Length") or 0)
+            if size < GEO_MMDB_MIN or (expect and size != expect): raise ValueError(f"mmdb size {size} (expected {expect or '>1MB'})")
+            if digest and h.hexdigest() != digest: raise ValueError("mmdb checksum mismatch")
+            self._open(tmp)   # 能正常解析元数据再替换
+            os.replace(tmp, self.path); self.downloads += 1
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def _digest(self):
+        if GEO_MMDB_SHA256: return GEO_MMDB_SHA256.strip().lower()
+        try:
+            r = requests.get(GEO_MMDB_SHA256_URL, timeout=(10, 30)); r.raise_for_status()
+            digest = r.text.split()[0].lower()
+        except Exception as e:
+            raise ValueError(f"mmdb checksum unavailable: {e}")
+        if not re.fullmatch(r"[0-9a-f]{64}", digest): raise ValueError("mmdb checksum unavailable: bad .sha256 file")
+        return digest
+
+    def stats(self):
+        meta = None
+        if self.reader is not None:
+            try: m = self.reader.metadata(); meta = {"type": m.database_type, "build_epoch": m.build_epoch}
+            except: pass
+        return {"loaded": self.reader is not None, "loads": self.loads, "downloads": self.downloads, "busy": self.busy, "error": self.error,
+                "fails": self.fails, "retry_in": max(0, round(self.retry_at - time.monotonic())), "verify": GEO_MMDB_VERIFY, "metadata": meta}
+
+geo_db = GeoDB(GEO_MMDB, GEO_MMDB_URL)
 def flag_emoji(cc):
     if not cc or len(cc)!=2: return ""
     cc=cc.upper(); return chr(0x1F1E6+ord(cc[0])-65)+chr(0x1F1E6+ord(cc[1])-65)
+GEO_UNKNOWN = {"text":"未知","cc":""}
 def geo_local(ip):
-    if ip in geo_cache_local: return geo_cache_local[ip]
-    _geo_reader_init()
+    hit=geo_cache_local.get(ip)
+    if hit is not None: return hit
     try: ipaddress.ip_address(ip)
-    except: geo_cache_local[ip]={"text":"未知","cc":""}; return geo_cache_local[ip]
-    if _geo_reader:
-        try:
-            rec=_geo_reader.city(ip)
-            country=(rec.country.names.get("zh-CN") or rec.country.name or "")
-            cc=rec.country.iso_code or ""
-            region=(rec.subdivisions.most_specific.names.get("zh-CN") or rec.subdivisions.most_specific.name or "")
-            city=(rec.city.names.get("zh-CN") or rec.city.name or "")
-            text=",".join([x for x in [country,region,city] if x]) or "未知"
-            geo_cache_local[ip]={"text":text,"cc":cc}; return geo_cache_local[ip]
-        except: pass
-    geo_cache_local[ip]={"text":"未知","cc":""}; return geo_cache_local[ip]
-def geo_online(ip):
-    if ip in geo_cache_online: return geo_cache_online[ip]
+    except: return GEO_UNKNOWN
+    reader=geo_db.get()
+    if reader is None: return GEO_UNKNOWN   # 库尚未就绪，不缓存结果
     try:
-        r=requests.get(f"http://ip-api.com/json/{ip}?lang=zh-CN", timeout=3)
-        data=r.json()
-        if data.get("status")=="success":
-            country=data.get("country","") or ""; cc=data.get("countryCode","") or ""
-            region=data.get("regionName","") or ""; city=data.get("city","") or ""; isp=data.get("isp","") or ""
-            text=",".join([x for x in [country,region,city] if x]); 
-            if isp: text+=f" | {isp}"
-            text=text or "未知"
-            geo_cache_online[ip]={"text":text,"cc":cc}
-        else:
-            geo_cache_online[ip]={"text":"未知","cc":""}
-    except:
-        geo_cache_online[ip]={"text":"未知","cc":""}
-    return geo_cache_online[ip]
+        rec=reader.city(ip); net=rec.traits.network or ip
+        country=(rec.country.names.get("zh-CN") or rec.country.name or "")
+        cc=rec.country.iso_code or ""
+        region=(rec.subdivisions.most_specific.names.get("zh-CN") or rec.subdivisions.most_specific.name or "")
+        city=(rec.city.names.get("zh-CN") or rec.city.name or "")
+        text=",".join([x for x in [country,region,city] if x]) or "未知"
+        return geo_cache_local.put(net, {"text":text,"cc":cc})
+    except Exception as e:
+        net=getattr(e, "network", None) or ip   # 未收录的地址同样按库中的空网段缓存
+    return geo_cache_local.put(net, GEO_UNKNOWN, negative=True)
+# 在线查询：去重后经 ip-api 批量接口（每次最多 100 个）后台解析，限速并限制并发，结果写入缓存
+GEO_ONLINE_URL = os.environ.get("FW_GEO_ONLINE_URL", "http://ip-api.com")  # 测试时可指向本地桩服务
+GEO_ONLINE_FIELDS = "status,message,country,countryCode,regionName,city,isp,query"
+GEO_BATCH = 100
+GEO_BATCH_RATE = 15/60.0   # ip-api 批量接口限额：每分钟 15 次
+GEO_CONCURRENCY = 2
+
+class RateLimiter:
+    # 令牌桶限速，rate 为每秒补充的令牌数；pause() 用于遵从服务端返回的限额重置时间
+    def __init__(self, rate, burst=1):
+        self.rate = rate; self.burst = burst; self.tokens = burst; self.ts = time.monotonic(); self.until = 0; self.lock = None
+
+    def pause(self, seconds):
+        self.until = max(self.until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        if self.lock is None: self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.until: await asyncio.sleep(self.until - now); continue
+                self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate); self.ts = now
+                if self.tokens >= 1: self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def geo_online_wanted(ip):
+    # 内网、保留地址不做在线查询
+    try: return ipaddress.ip_address(ip).is_global
+    except ValueError: return False
+
+def geo_online_store(ip, data):
+    if (data or {}).get("status")=="success":
+        country=data.get("country","") or ""; cc=data.get("countryCode","") or ""
+        region=data.get("regionName","") or ""; city=data.get("city","") or ""; isp=data.get("isp","") or ""
+        text=",".join([x for x in [country,region,city] if x])
+        if isp: text+=f" | {isp}"
+        return geo_cache_online.put(geo_prefix(ip), {"text":text or "未知","cc":cc})
+    return geo_cache_online.put(geo_prefix(ip), GEO_UNKNOWN, negative=True)
+
+class GeoResolver:
+    # 待查队列与在途集合都以网段为键，同一网段只查询一个代表地址
+    def __init__(self):
+        self.pending = OrderedDict(); self.inflight = set(); self.lock = threading.Lock(); self.running = False
+        self.sem = None; self.limiter = RateLimiter(GEO_BATCH_RATE, burst=GEO_CONCURRENCY)
+        self.batches = self.resolved = self.failed = 0; self.tasks = set(); self.error = ""
+
+    def submit(self, ips):
+        with self.lock:
+            for ip in ips:
+                net = geo_prefix(ip)
+                if net not in self.inflight and net not in self.pending: self.pending[net] = ip
+            if not self.pending or self.running: return
+            self.running = True
+        if not spawn(self._drain):
+            with self.lock: self.running = False
+
+    async def _drain(self):
+        if self.sem is None: self.sem = asyncio.Semaphore(GEO_CONCURRENCY)
+        while True:
+            with self.lock:
+                items = [self.pending.popitem(last=False) for _ in range(min(GEO_BATCH, len(self.pending)))]
+                if not items: self.running = False; return
+                self.inflight.update(net for net, ip in items); batch = [ip for net, ip in items]
+            await self.limiter.acquire(); await self.sem.acquire()
+            # 事件循环只持有任务的弱引用，在途批次需在此保留引用直到完成
+            task = asyncio.create_task(self._fetch(batch)); self.tasks.add(task); task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.failed += 1; self.error = repr(task.exception())
+
+    async def _fetch(self, batch):
+        retry = False
+        try:
+            r = await asyncio.to_thread(requests.post, f"{GEO_ONLINE_URL}/batch?lang=zh-CN&fields={GEO_ONLINE_FIELDS}",
+                                        json=[{"query": ip} for ip in batch], timeout=5)
+            if r.headers.get("X-Rl") == "0": self.limiter.pause(int(r.headers.get("X-Ttl") or 60))
+            if r.status_code == 429:
+                self.limiter.pause(int(r.headers.get("X-Ttl") or 60)); retry = True; return
+            got = {}
+            for item in r.json():
+                if isinstance(item, dict) and item.get("query") in batch: got[item["query"]] = item
+            for ip in batch: geo_online_store(ip, got.get(ip))
+            self.batches += 1; self.resolved += len(got)
+        except Exception:
+            self.failed += 1
+            for ip in batch: geo_cache_online.put(geo_prefix(ip), GEO_UNKNOWN, negative=True)
+        finally:
+            self.sem.release()
+            with self.lock: self.inflight.difference_update(geo_prefix(ip) for ip in batch)
+            if retry: self.submit(batch)
+
+    def stats(self):
+        return {"pending": len(self.pending), "inflight": len(self.inflight), "batches": self.batches, "resolved": self.resolved, "failed": self.failed,
+                "tasks": len(self.tasks), "error": self.error}
+
+geo_resolver = GeoResolver()
+
+def geo_many(ips):
+    # 批量取地理信息：去重后本地库逐个查询（有缓存），在线结果只读缓存，未命中的交给后台批量解析，
+    # 接口因此立即返回，在线信息在后续轮询中补齐
+    out={}; miss=[]
+    for ip in dict.fromkeys(normalize_ip(x) for x in ips):
+        l=geo_local(ip); o=geo_cache_online.get(ip)
+        if o is None:
+            o=GEO_UNKNOWN
+            if geo_online_wanted(ip): miss.append(ip); o={"text":"","cc":""}
+        out[ip]={"local":l["text"], "online":o["text"], "flag":flag_emoji(o["cc"] or l["cc"])}
+    if miss: geo_resolver.submit(miss)
+    return out
+
 def geo_both(ip):
-    ip=normalize_ip(ip); l=geo_local(ip); o=geo_online(ip)
-    return {"local":l["text"], "online":o["text"], "flag":flag_emoji(o["cc"] or l["cc"])}
+    ip=normalize_ip(ip); return geo_many([ip])[ip]
+
+@app.get("/api/geo/stats")
+def api_geo_stats(request: Request):
+    require_auth(request)
+    return {"local": geo_cache_local.stats(), "online": geo_cache_online.stats(), "resolver": geo_resolver.stats(), "mmdb": geo_db.stats()}
 
 # ---- Pages ----
 def login_html():
@@ -335,16 +1188,15 @@ def login_page():
     return login_html()
 
 @app.post("/login")
-def login(request: Request, username: str = Form(...), password: str = Form(...)):
+async def login(request: Request, username: str = Form(...), password: str = Form(...)):
     ip = normalize_ip(request.client.host)
     if username==USERNAME and password==PASSWORD:
         request.session["logged_in"]=True
         log_action(username, ip, "login success")
         try:
             ipaddress.ip_address(ip)
-            if ip not in whitelist:
-                if len(whitelist) >= MAX_WL: whitelist.popleft()
-                whitelist.append(ip); wl_save(list(whitelist)); ufw_allow_from_ip_any(ip)
+            if not whitelist.covers(ip):
+                added, evicted = wl_add([ip]); await wl_apply_change(added, evicted)
         except: pass
         return RedirectResponse("/", 302)
     log_action(username, ip, "login failed")
@@ -376,18 +1228,18 @@ def api_panel_cred_get(request: Request):
 
 @app.post("/api/panel/set")
 @audit("panel port set {port}")
-def api_panel_set(request: Request, port: int = Form(...)):
+async def api_panel_set(request: Request, port: int = Form(...)):
     require_auth(request)
     port=int(port);
     if port<1 or port>65535: return JSONResponse({"error":"invalid port"}, status_code=400)
     state["panel_port"]=port; state_save(state)
-    subprocess.run(f"ufw allow {port}/tcp comment 'fw-web-panel'", shell=True)  # 永久放行新端口
-    threading.Thread(target=lambda: (time.sleep(1), os._exit(3))).start()
+    await ufw_allow_anywhere(port)  # 永久放行新端口
+    threading.Thread(target=lambda: (time.sleep(1), persist.flush(), os._exit(3))).start()
     return {"status":"ok","msg":"端口已保存，服务即将自动重启生效","panel_port":port}
 
 @app.post("/api/panel/cred")
 @audit("panel cred set user {username} port {port}")
-def api_panel_cred_set(request: Request, username: str = Form(...), password: str = Form(...), port: int = Form(...)):
+async def api_panel_cred_set(request: Request, username: str = Form(...), password: str = Form(...), port: int = Form(...)):
     require_auth(request)
     port=int(port)
     if port<1 or port>65535 or not username or not password:
@@ -398,8 +1250,8 @@ def api_panel_cred_set(request: Request, username: str = Form(...), password: st
     state_save(state)
     global USERNAME, PASSWORD
     USERNAME=username; PASSWORD=password
-    subprocess.run(f"ufw allow {port}/tcp comment 'fw-web-panel'", shell=True)
-    threading.Thread(target=lambda: (time.sleep(1), os._exit(3))).start()
+    await ufw_allow_anywhere(port)
+    threading.Thread(target=lambda: (time.sleep(1), persist.flush(), os._exit(3))).start()
     return {"status":"ok","panel_port":port,"username":username}
 
 # ---- Port forward APIs ----
@@ -410,10 +1262,10 @@ def api_forward_list(request: Request):
 
 @app.post("/api/forward/add")
 @audit("forward add {src_port}->{dst_ip}:{dst_port}")
-def api_forward_add(request: Request, src_port: int = Form(...), dst_ip: str = Form(...), dst_port: int = Form(...)):
+async def api_forward_add(request: Request, src_port: int = Form(...), dst_ip: str = Form(...), dst_port: int = Form(...)):
     require_auth(request)
     try:
-        ipaddress.ip_address(dst_ip)
+        if ipaddress.ip_address(dst_ip).version != 4: return JSONResponse({"error":"ipv6 target not supported"}, status_code=400)
     except:
         return JSONResponse({"error":"invalid ip"}, status_code=400)
     src_port=int(src_port); dst_port=int(dst_port)
@@ -421,88 +1273,89 @@ def api_forward_add(request: Request, src_port: int = Form(...), dst_ip: str = F
         return JSONResponse({"error":"invalid port"}, status_code=400)
     forwards=[f for f in state.get("forwards", []) if f.get("src_port")!=src_port]
     forwards.append({"src_port":src_port,"dst_ip":dst_ip,"dst_port":dst_port})
-    state["forwards"]=forwards; state_save(state)
-    apply_forward_rules()
+    state["forwards"]=forwards
+    persist.op("INSERT OR REPLACE INTO forwards(src_port, dst_ip, dst_port, created_at) VALUES(?, ?, ?, ?)", (src_port, dst_ip, dst_port, time.time()))
+    res=await apply_forward_rules()
+    if "error" in res: return JSONResponse({"error":res["error"]}, status_code=500)
     return {"status":"ok"}
 
 @app.post("/api/forward/delete/{src_port}")
 @audit("forward delete {src_port}")
-def api_forward_delete(src_port: int, request: Request):
+async def api_forward_delete(src_port: int, request: Request):
     require_auth(request)
     src_port=int(src_port)
-    forwards=[f for f in state.get("forwards", []) if f.get("src_port")!=src_port]
-    state["forwards"]=forwards; state_save(state)
-    apply_forward_rules()
+    state["forwards"]=[f for f in state.get("forwards", []) if f.get("src_port")!=src_port]
+    persist.op("DELETE FROM forwards WHERE src_port=?", (src_port,))
+    res=await apply_forward_rules()
+    if "error" in res: return JSONResponse({"error":res["error"]}, status_code=500)
     return {"status":"ok"}
 
 # ---- UFW APIs ----
 @app.get("/api/ports")
 def api_ports(request: Request):
-    require_auth(request); return {"rules": run("ufw status numbered").splitlines()}
+    require_auth(request); m=ufw_model()
+    return {"enabled": m["enabled"], "rules": m["lines"], "items": m["items"]}
+
+@app.get("/api/cmdstats")
+def api_cmdstats(request: Request):
+    require_auth(request)
+    return {"stats": cmd_runner.stats, "recent": list(cmd_runner.recent)[-50:],
+            "queued": cmd_runner.queue.qsize() if cmd_runner.queue else 0}
 
 @app.post("/api/open/{port}")
 @audit("open port {port}")
-def api_open_port(port: int, request: Request):
+async def api_open_port(port: int, request: Request):
     require_auth(request)
-    for ip in list(whitelist): ufw_allow_from_ip_port(ip, port)
-    panel = state.get("panel_port", DEFAULT_PORT)
+    if not 1 <= port <= 65535: raise HTTPException(400, "port")
+    if not WL_IPSET:  # ipset 模式下白名单来源已整体放行，无需逐 IP 的端口规则
+        res=await ufw_apply([ufw_rule(src=ip, dport=port, comment=OPEN_TAG) for ip in whitelist])
+        if "error" in res: raise HTTPException(500, res["error"])
+    panel = state.get("panel_port", DEFAULT_PORT); res={"removed":0,"ms":0}
     if port != panel:
-        for line in reversed(run("ufw status numbered").splitlines()):
-            if "]" in line and "ALLOW IN" in line and "From Anywhere" in line and f"{port}" in line:
-                try: num=int(line.split("]")[0].strip("[ ")); ufw_delete_rule_number(num)
-                except: pass
-    return {"status": f"port {port} allowed for whitelist only"}
+        res=await ufw_delete_where(lambda r: ufw_allow_in(r) and ufw_is_any(r.src) and ufw_port_match(r.dport, port))
+        if "error" in res: raise HTTPException(500, res["error"])
+    return {"status": f"port {port} allowed for whitelist only", "deleted_anywhere": res["removed"], "ms": res["ms"]}
 
 @app.get("/api/whitelist")
 def api_wl(request: Request):
     require_auth(request)
-    res=[]
-    for ip in list(whitelist):
-        g=geo_both(ip)
-        res.append({"ip":ip,"local":g["local"],"online":g["online"],"flag":g["flag"]})
+    res=[]; entries=list(whitelist); geo=geo_many(e.split("/")[0] for e in entries)
+    for ip in entries:
+        g=geo[ip.split("/")[0]]
+        res.append({"ip":ip,"local":g["local"],"online":g["online"],"flag":g["flag"],"added_at":whitelist.items.get(ip),"last_seen":wl_seen.get(ip)})
     return {"whitelist":res}
 
-@app.post("/api/whitelist/{ip}")
-@audit("whitelist add {ip}")
-def api_wl_add(ip: str, request: Request):
-    require_auth(request)
-    ip=normalize_ip(ip)
-    try: ipaddress.ip_address(ip)
-    except: return {"status":"invalid ip"}
-    if ip not in whitelist:
-        if len(whitelist)>=MAX_WL: whitelist.popleft()
-        whitelist.append(ip); wl_save(list(whitelist))
-        ufw_allow_from_ip_any(ip)
-    return {"status": f"{ip} added"}
-
-@app.post("/api/whitelist/delete/{ip}")
+# 删除路由需在添加路由之前注册，否则 /api/whitelist/delete/... 会被 {ip:path} 吞掉
+@app.post("/api/whitelist/delete/{ip:path}")
 @audit("whitelist delete {ip}")
-def api_wl_del(ip: str, request: Request):
+async def api_wl_del(ip: str, request: Request):
     require_auth(request)
-    ip=normalize_ip(ip)
-    try: whitelist.remove(ip)
+    ip=wl_normalize(ip) or normalize_ip(ip)
+    try: whitelist.remove(ip); wl_forget(ip)
     except: pass
-    wl_save(list(whitelist))
-    for line in reversed(run("ufw status numbered").splitlines()):
-        if "]" in line and "ALLOW IN" in line and f"From {ip}" in line:
-            try: num=int(line.split("]")[0].strip("[ ")); ufw_delete_rule_number(num)
-            except: pass
-    return {"status": f"{ip} removed"}
+    if WL_IPSET: await ipset_update(removed=[ip])
+    res=await ufw_delete_where(lambda r: ufw_allow_in(r) and r.src == ip)
+    return {"status": f"{ip} removed", "deleted": res["removed"], "ms": res["ms"]}
+
+@app.post("/api/whitelist/{ip:path}")
+@audit("whitelist add {ip}")
+async def api_wl_add(ip: str, request: Request):
+    require_auth(request)
+    ip=wl_normalize(ip)
+    if not ip: return {"status":"invalid ip"}
+    added, evicted = wl_add([ip])
+    if added: await wl_apply_change(added, evicted)
+    return {"status": f"{ip} added"}
 
 @app.post("/api/ufw/strictify")
 @audit("strictify")
-def api_strictify(request: Request):
+async def api_strictify(request: Request):
     require_auth(request)
     panel = state.get("panel_port", DEFAULT_PORT)
-    deleted=0
-    for line in reversed(run("ufw status numbered").splitlines()):
-        if "]" in line and "ALLOW IN" in line and "From Anywhere" in line:
-            if f"{panel}" in line:  # 面板端口跳过
-                continue
-            try: num=int(line.split("]")[0].strip("[ ")); ufw_delete_rule_number(num); deleted+=1
-            except: pass
-    subprocess.run(f"ufw allow {panel}/tcp comment 'fw-web-panel'", shell=True)
-    return {"status":"ok","deleted_anywhere":deleted,"panel_port":panel}
+    # 面板端口跳过
+    res=await ufw_delete_where(lambda r: ufw_allow_in(r) and ufw_is_any(r.src) and not ufw_port_match(r.dport, panel))
+    await ufw_allow_anywhere(panel)
+    return {"status":"ok","deleted_anywhere":res["removed"],"ms":res["ms"],"panel_port":panel}
 
 # ---- Export/Import/Logs ----
 @app.get("/export/whitelist")
@@ -510,8 +1363,9 @@ def export_wl(request: Request):
     if not request.session.get("logged_in") and not check_basic_header(request):
         return RedirectResponse("/login")
     tmp=tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".txt")
-    for ip in list(whitelist):
-        g=geo_both(ip); tmp.write(f"{ip} | {g['flag']} 本地:{g['local']} 在线:{g['online']}\n")
+    entries=list(whitelist); geo=geo_many(e.split("/")[0] for e in entries)
+    for ip in entries:
+        g=geo[ip.split("/")[0]]; tmp.write(f"{ip} | {g['flag']} 本地:{g['local']} 在线:{g['online']}\n")
     tmp.close()
     return FileResponse(tmp.name, filename="whitelist.txt", media_type="text/plain")
 
@@ -519,86 +1373,708 @@ def export_wl(request: Request):
 async def import_wl(request: Request, file: UploadFile = File(...)):
     if not request.session.get("logged_in") and not check_basic_header(request):
         return RedirectResponse("/login")
-    content=(await file.read()).decode(errors="ignore"); added=0
-    for line in content.splitlines():
-        ip=line.split("|")[0].strip()
-        try:
-            ipaddress.ip_address(ip)
-            if ip not in whitelist:
-                if len(whitelist)>=MAX_WL: whitelist.popleft()
-                whitelist.append(ip); ufw_allow_from_ip_any(ip); added+=1
-        except: pass
-    wl_save(list(whitelist))
+    content=(await file.read()).decode(errors="ignore")
+    entries=[e for e in (wl_normalize(line.split("|")[0]) for line in content.splitlines()) if e]
+    added, evicted = wl_add(entries)
+    if added: await wl_apply_change(added, evicted)
     return RedirectResponse("/", 302)
 
 @app.get("/export/logs")
 def export_logs(request: Request):
     require_auth(request)
+    audit_log.flush()
     if not os.path.exists(LOG_FILE): return PlainTextResponse("暂无日志")
     return FileResponse(LOG_FILE, filename="firewall.log", media_type="text/plain")
 
+# 审计日志查询：按用户 / IP / 动作前缀 / 时间范围过滤，按 id 倒序游标分页，以 NDJSON 流式返回
+AUDIT_PAGE = 500
+
+def parse_time(x):
+    # 支持 Unix 时间戳或 "YYYY-MM-DD[ HH:MM[:SS]]"
+    x=(x or "").strip()
+    if not x: return None
+    try: return float(x)
+    except ValueError: pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try: return datetime.datetime.strptime(x, fmt).timestamp()
+        except ValueError: pass
+    raise HTTPException(status_code=400, detail=f"invalid time: {x}")
+
+@app.get("/api/logs")
+def api_logs(request: Request, user: str = "", ip: str = "", action: str = "", since: str = "", until: str = "", cursor: int = 0, limit: int = 1000):
+    require_auth(request)
+    where=[]; args=[]
+    if user: where.append("user = ?"); args.append(user)
+    if ip: where.append("ip = ?"); args.append(normalize_ip(ip))
+    if action: where.append("action >= ? AND action < ?"); args += [action, action + "\U0010ffff"]  # 前缀匹配可走索引
+    t0, t1 = parse_time(since), parse_time(until)
+    if t0 is not None: where.append("ts >= ?"); args.append(t0)
+    if t1 is not None: where.append("ts < ?"); args.append(t1)
+    limit=max(1, min(int(limit), 100000))
+    audit_log.flush()
+    def gen():
+        last=int(cursor) if cursor>0 else None; sent=0
+        while sent < limit:
+            cond=where + (["id < ?"] if last else [])
+            sql="SELECT id, ts, user, ip, action FROM audit" + (" WHERE " + " AND ".join(cond) if cond else "") + " ORDER BY id DESC LIMIT ?"
+            rows=store.query(sql, args + ([last] if last else []) + [min(AUDIT_PAGE, limit - sent)])
+            for rid, ts, u, rip, act in rows:
+                yield json.dumps({"id": rid, "ts": ts, "time": datetime.datetime.fromtimestamp(ts).strftime("%F %T"), "user": u, "ip": rip, "action": act}, ensure_ascii=False) + "\n"
+            sent += len(rows)
+            if not rows: last=None; break
+            last=rows[-1][0]
+        # 末行给出下一页游标，没有更多数据时为 null
+        if last:
+            more=store.query("SELECT 1 FROM audit" + " WHERE " + " AND ".join(where + ["id < ?"]) + " LIMIT 1", args + [last])
+            if not more: last=None
+        yield json.dumps({"next_cursor": last}) + "\n"
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
 @app.post("/api/loglimit/{mb}")
 @audit("set log limit {mb}MB")
-def set_log_limit(mb: int, request: Request):
+def set_log_limit(mb: int, request: Request, keep: int = 0):
     require_auth(request)
-    state["log_max_bytes"]=max(1,int(mb))*1024*1024; state_save(state)
-    rotate_log_if_needed(); return {"status":"ok","max_bytes":state["log_max_bytes"]}
+    state["log_max_bytes"]=max(1,int(mb))*1024*1024
+    if keep>0: state["log_keep"]=int(keep)
+    state_save(state)
+    audit_log.flush(); return {"status":"ok","max_bytes":state["log_max_bytes"],"keep":state["log_keep"]}
+
+@app.post("/api/wllimit/{n}")
+@audit("set whitelist limit {n}")
+async def set_wl_limit(n: int, request: Request):
+    # 调低上限时按 FIFO 立即淘汰多出的条目；ipset 模式下整体重建，使集合的 maxelem 随之更新
+    require_auth(request)
+    if n < 1: raise HTTPException(400, "n")
+    global WL_MAX
+    state["wl_max"]=WL_MAX=whitelist.maxlen=int(n); state_save(state)
+    evicted=[]
+    while len(whitelist) > n:
+        e=whitelist.popleft(); wl_forget(e); evicted.append(e)
+    res=await apply_whitelist_rules() if WL_IPSET or evicted else None
+    if res and "error" in res: raise HTTPException(500, res["error"])
+    return {"status":"ok","wl_max":WL_MAX,"evicted":len(evicted)}
 
 # ---- Traffic & Connections ----
+# 流量历史：后台按固定间隔采样各网卡计数器，速率写入定长环形缓冲区（array 存储），
+# 逐级降采样为 1 分钟与 1 小时两档；速率与轮询次数无关
+TRAFFIC_INTERVAL = 1
+TRAFFIC_TIERS = (("1s", 1, 3600), ("1m", 60, 1440), ("1h", 3600, 720))   # (名称, 粒度秒, 保留点数)
+TRAFFIC_POINTS = 600       # 历史接口单次返回的最大点数，超出时按桶取平均
+
+class Ring:
+    # 定长环形缓冲区：时间戳与收/发速率分别存放在 array('d') 中
+    def __init__(self, size):
+        self.size = size; self.head = 0; self.count = 0
+        self.ts = array.array("d", bytes(8 * size)); self.rx = array.array("d", bytes(8 * size)); self.tx = array.array("d", bytes(8 * size))
+
+    def append(self, ts, rx, tx):
+        i = self.head; self.ts[i] = ts; self.rx[i] = rx; self.tx[i] = tx
+        self.head = (i + 1) % self.size; self.count = min(self.count + 1, self.size)
+
+    def window(self, start, end):
+        # 按时间顺序返回 [start, end] 内的 (ts, rx, tx)；时间戳单调递增，用二分定位
+        n = self.count; first = (self.head - n) % self.size
+        order = lambda a: a[first:first + n] if first + n <= self.size else a[first:] + a[:self.head]
+        ts, rx, tx = order(self.ts), order(self.rx), order(self.tx)
+        i = bisect.bisect_left(ts, start); j = bisect.bisect_right(ts, end)
+        return ts[i:j], rx[i:j], tx[i:j]
+
+def traffic_stats(values):
+    if not values: return {"min": 0, "avg": 0, "max": 0, "p95": 0}
+    if np is not None:
+        v = np.frombuffer(values, dtype=np.float64)
+        return {"min": float(v.min()), "avg": float(v.mean()), "max": float(v.max()), "p95": float(np.percentile(v, 95))}
+    v = sorted(values); k = (len(v) - 1) * 0.95; f = math.floor(k); c = min(f + 1, len(v) - 1)
+    return {"min": v[0], "avg": sum(v) / len(v), "max": v[-1], "p95": v[f] + (v[c] - v[f]) * (k - f)}
+
+def traffic_resample(ts, rx, tx, points):
+    n = len(ts)
+    if n <= points: return list(ts), list(rx), list(tx)
+    step = math.ceil(n / points); m = n // step * step
+    if np is not None:
+        f = lambda a: np.frombuffer(a, dtype=np.float64)[:m].reshape(-1, step)
+        out = (f(ts)[:, 0].tolist(), f(rx).mean(axis=1).tolist(), f(tx).mean(axis=1).tolist())
+    else:
+        out = (list(ts[0:m:step]), [sum(rx[i:i + step]) / step for i in range(0, m, step)], [sum(tx[i:i + step]) / step for i in range(0, m, step)])
+    if m < n:
+        out[0].append(ts[m]); out[1].append(sum(rx[m:]) / (n - m)); out[2].append(sum(tx[m:]) / (n - m))
+    return out
+
+class TrafficHistory:
+    def __init__(self):
+        self.rings = {}; self.acc = {}; self.last = None; self.last_ts = 0; self.rates = {}; self.saved = 0
+        self.lock = threading.Lock(); self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            try: self.sample()
+            except: pass
+            await asyncio.sleep(TRAFFIC_INTERVAL - time.time() % TRAFFIC_INTERVAL)
+
+    def sample(self):
+        now = time.time(); cur = {k: (v.bytes_recv, v.bytes_sent) for k, v in psutil.net_io_counters(pernic=True).items()}
+        cur["all"] = tuple(map(sum, zip(*cur.values()))) if cur else (0, 0)
+        if self.last is None:
+            # 首次采样：补记面板停止期间的累计流量（计数器未归零时）
+            rx, tx = cur["all"]
+            if rx >= state.get("last_rx", 0) and tx >= state.get("last_tx", 0):
+                state["acc_rx"] += rx - state.get("last_rx", 0); state["acc_tx"] += tx - state.get("last_tx", 0)
+            self.last, self.last_ts = cur, now; return
+        dt = max(0.001, now - self.last_ts); rates = {}
+        for k, (rx, tx) in cur.items():
+            prx, ptx = self.last.get(k, (rx, tx))
+            # 计数器回绕或网卡重建时差值为负，按 0 处理
+            rates[k] = (max(0, rx - prx) / dt, max(0, tx - ptx) / dt)
+        state["acc_rx"] += rates["all"][0] * dt; state["acc_tx"] += rates["all"][1] * dt
+        state["last_rx"], state["last_tx"] = cur["all"]
+        with self.lock:
+            for k, (rx, tx) in rates.items(): self._push(k, now, rx, tx)
+        self.rates = rates; self.last, self.last_ts = cur, now
+        if now - self.saved >= 60: self.saved = now; state_save(state)
+
+    def _push(self, iface, ts, rx, tx):
+        rings = self.rings.get(iface)
+        if rings is None:
+            rings = self.rings[iface] = [Ring(size) for _, _, size in TRAFFIC_TIERS]; self.acc[iface] = [None] * len(TRAFFIC_TIERS)
+        rings[0].append(ts, rx, tx); acc = self.acc[iface]
+        for lvl in range(1, len(TRAFFIC_TIERS)):
+            step = TRAFFIC_TIERS[lvl][1]; bucket = ts - ts % step; a = acc[lvl]
+            if a is None or a[0] == bucket:
+                if a is None: acc[lvl] = [bucket, rx, tx, 1]
+                else: a[1] += rx; a[2] += tx; a[3] += 1
+                return
+            # 进入新桶：上一桶的平均值写入本档，并作为一个点继续累加到更粗的一档
+            acc[lvl] = [bucket, rx, tx, 1]
+            ts, rx, tx = a[0], a[1] / a[3], a[2] / a[3]
+            rings[lvl].append(ts, rx, tx)
+
+    def history(self, iface, start, end, tier, points, now=None):
+        now = now or time.time()
+        with self.lock:
+            rings = self.rings.get(iface)
+            if rings is None: return None
+            if tier == "auto":
+                # 选择保留范围能覆盖起点的最细粒度；容差一个粒度，使恰为保留时长的窗口（如默认的最近一小时）仍落在该层
+                lvl = next((i for i, (_, step, size) in enumerate(TRAFFIC_TIERS) if now - step * size <= start + step), len(TRAFFIC_TIERS) - 1)
+            else:
+                lvl = [t[0] for t in TRAFFIC_TIERS].index(tier)
+            ts, rx, tx = rings[lvl].window(start, end)
+        rts, rrx, rtx = traffic_resample(ts, rx, tx, points)
+        return {"iface": iface, "tier": TRAFFIC_TIERS[lvl][0], "start": start, "end": end, "count": len(ts),
+                "ts": rts, "rx": rrx, "tx": rtx, "stats": {"rx": traffic_stats(rx), "tx": traffic_stats(tx)}}
+
+traffic_hist = TrafficHistory()
+
 @app.get("/api/traffic")
 def api_traffic(request: Request):
     require_auth(request)
-    io=psutil.net_io_counters(); rx,tx=io.bytes_recv, io.bytes_sent
-    now=time.time()
-    last_ts=float(state.get("last_ts",0.0)); last_rx=int(state.get("last_rx",0)); last_tx=int(state.get("last_tx",0))
-    rx_rate=tx_rate=0.0
-    if last_ts>0:
-        dt=max(0.001, now-last_ts); drx=max(0, rx-last_rx); dtx=max(0, tx-last_tx)
-        rx_rate=drx/dt; tx_rate=dtx/dt; state["acc_rx"]+=drx; state["acc_tx"]+=dtx
-    state["last_rx"],state["last_tx"],state["last_ts"]=rx,tx,now; state_save(state)
+    now=time.time(); rx_rate,tx_rate=traffic_hist.rates.get("all",(0.0,0.0))
     ifs=[{"iface":iface,"rx":st.bytes_recv,"tx":st.bytes_sent} for iface,st in psutil.net_io_counters(pernic=True).items()]
     return {"acc_rx":state["acc_rx"],"acc_tx":state["acc_tx"],"rx_rate":rx_rate,"tx_rate":tx_rate,"ifaces":ifs,"ts":now}
 
-@app.get("/api/connections")
-def api_connections(request: Request):
+@app.get("/api/traffic/history")
+def api_traffic_history(request: Request, iface: str = "all", start: float = 0, end: float = 0, tier: str = "auto", points: int = TRAFFIC_POINTS):
+    # start/end 为 Unix 时间戳，缺省为最近一小时；tier 为 auto/1s/1m/1h
+    require_auth(request)
+    if tier != "auto" and tier not in [t[0] for t in TRAFFIC_TIERS]: raise HTTPException(400, "tier")
+    now=time.time(); end=end or now; start=start or end-3600
+    res=traffic_hist.history(iface, start, end, tier, max(1, min(points, 10000)), now)
+    if res is None: raise HTTPException(404, "iface")
+    return res
+
+# ---- 流量计量：为每个端口转发与白名单条目安装只计数的 iptables 规则（放在独立链中），
+# 每个采样周期用一次 iptables-save -c 读取全部计数器，速率写入环形缓冲区 ----
+ACCT_ENABLED = shutil.which("iptables-save") is not None
+ACCT_INTERVAL = 10
+ACCT_POINTS = 360          # 每个对象保留的采样点数（默认 1 小时）
+ACCT_WL_MAX = 1024         # 计数规则为线性匹配，白名单只统计最近加入的这么多条
+ACCT_CHAINS = {"INPUT": "FWWEB-ACCT-IN", "OUTPUT": "FWWEB-ACCT-OUT", "FORWARD": "FWWEB-ACCT-FWD"}
+_ACCT_LINE = re.compile(r'^\[(\d+):(\d+)\] -A (FWWEB-ACCT-\S+) .*--comment "?(' + ACCT_TAG + r':[^" ]+)')
+
+def acct_rules():
+    # 返回 {4/6: [规则行]}；注释为 fw-web-acct:<类别>:<对象>:<in|out>，in 为流向本机/转发目标的字节
+    out = {4: [], 6: []}; fin, fout, ffwd = ACCT_CHAINS["INPUT"], ACCT_CHAINS["OUTPUT"], ACCT_CHAINS["FORWARD"]
+    for sp, dip, dp in forward_targets():
+        if ":" in dip: continue
+        key = f"fwd:{sp}>{dip}:{dp}"
+        out[4].append(f"-A {ffwd} -d {dip}/32 -p tcp -m tcp --dport {dp} -m comment --comment {ACCT_TAG}:{key}:in")
+        out[4].append(f"-A {ffwd} -s {dip}/32 -p tcp -m tcp --sport {dp} -m comment --comment {ACCT_TAG}:{key}:out")
+    for e in list(whitelist)[-ACCT_WL_MAX:]:
+        net = str(ipaddress.ip_network(e, strict=False)); fam = 6 if ":" in net else 4
+        out[fam].append(f"-A {fin} -s {net} -m comment --comment {ACCT_TAG}:wl:{net}:in")
+        out[fam].append(f"-A {fout} -d {net} -m comment --comment {ACCT_TAG}:wl:{net}:out")
+    return out
+
+@fw_serial
+async def acct_install(fam, rules):
+    # 在 --noflush 模式下声明自有链即清空该链，重建计数规则；内置链中的跳转规则缺失时补上
+    tool = "ip6tables" if fam == 6 else "iptables"
+    payload = "*filter\n" + "".join(f":{c} - [0:0]\n" for c in ACCT_CHAINS.values()) + "".join(l + "\n" for l in rules) + "COMMIT\n"
+    if (await cmd_runner.exec([f"{tool}-restore", "--noflush"], input=payload)).rc != 0: return False
+    await acct_hook(fam)
+    return True
+
+async def acct_hook(fam):
+    # 计数链只计数不终止，跳转固定放在内置链第一条；不在首位（如 ipset_hook 之后插入了放行规则）时移到首位
+    tool = "ip6tables" if fam == 6 else "iptables"
+    for builtin, chain in ACCT_CHAINS.items():
+        jump = f"-A {builtin} -j {chain}"; rules = [l for l in (await run([tool, "-S", builtin])).splitlines() if l.startswith("-A ")]
+        if rules[:1] == [jump]: continue
+        if jump in rules: await cmd_runner.exec([tool, "-D", builtin, "-j", chain])
+        await cmd_runner.exec([tool, "-I", builtin, "1", "-j", chain])
+
+class Accounting:
+    def __init__(self):
+        self.installed = {4: None, 6: None}; self.prev = {}; self.ts = 0
+        self.rings = {}; self.totals = {}; self.rates = {}; self.lock = threading.Lock(); self.task = None; self.error = ""
+
+    def start(self):
+        if ACCT_ENABLED: self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            try: await self.sample()
+            except Exception as e: self.error = str(e)
+            await asyncio.sleep(ACCT_INTERVAL)
+
+    async def sample(self):
+        want = acct_rules(); now = time.time(); counters = {}
+        keys = {l.rpartition(" --comment ")[2][len(ACCT_TAG) + 1:].rpartition(":")[0] for rules in want.values() for l in rules}
+        for fam, rules in want.items():
+            if not rules and self.installed[fam] is None: continue
+            tool = "ip6tables" if fam == 6 else "iptables"
+            save = await run([f"{tool}-save", "-c", "-t", "filter"])
+            hooked = all(f"-A {b} -j {c}" in save for b, c in ACCT_CHAINS.items())
+            lines = [l.split("] ", 1)[-1] for l in save.splitlines()]
+            if hooked and not all(next((l for l in lines if l.startswith(f"-A {b} ")), "") == f"-A {b} -j {c}" for b, c in ACCT_CHAINS.items()):
+                await acct_hook(fam)  # 跳转存在但被插到其它规则之后：只调整位置，计数器不受影响
+            if rules != self.installed[fam] or not hooked:
+                # 规则集变化（或 ufw reload 后跳转丢失）时重建，计数器随之清零：本周期不读取该族计数，
+                # 其对象的 prev 随之丢弃、下个周期重新取基准，历史与累计字节保留
+                if await acct_install(fam, rules): self.installed[fam] = rules
+                continue
+            for line in save.splitlines():
+                m = _ACCT_LINE.match(line)
+                if m:
+                    key, _, d = m.group(4)[len(ACCT_TAG) + 1:].rpartition(":")
+                    counters.setdefault(key, [0, 0])[0 if d == "in" else 1] += int(m.group(2))
+        dt = now - self.ts if self.ts else 0; rates = {}
+        with self.lock:
+            for key, (bi, bo) in counters.items():
+                pi, po = self.prev.get(key, (None, None))
+                if pi is None or not dt: continue
+                # 计数器变小说明规则被重建，本周期按从零开始计算
+                di = bi - pi if bi >= pi else bi; do = bo - po if bo >= po else bo
+                tot = self.totals.setdefault(key, [0, 0]); tot[0] += di; tot[1] += do
+                rates[key] = (di / dt, do / dt)
+                ring = self.rings.get(key)
+                if ring is None: ring = self.rings[key] = Ring(ACCT_POINTS)
+                ring.append(now, di / dt, do / dt)
+            for key in [k for k in self.rings if k not in keys]: del self.rings[key]
+            for key in [k for k in self.totals if k not in keys]: del self.totals[key]
+            self.prev = {k: tuple(v) for k, v in counters.items()}; self.rates = rates; self.ts = now
+
+    def top(self, n, window, kind):
+        start = time.time() - window; out = []
+        with self.lock:
+            for key, ring in self.rings.items():
+                if kind and not key.startswith(kind + ":"): continue
+                ts, rx, tx = ring.window(start, float("inf"))
+                if not ts: continue
+                ri = sum(rx) / len(rx); ro = sum(tx) / len(tx); tot = self.totals.get(key, [0, 0])
+                out.append({"key": key, "kind": key.split(":", 1)[0], "target": key.split(":", 1)[1], "in_rate": ri, "out_rate": ro,
+                            "in_bytes": tot[0], "out_bytes": tot[1]})
+        out.sort(key=lambda x: x["in_rate"] + x["out_rate"], reverse=True)
+        return out[:n]
+
+    def history(self, key, start, end, points):
+        with self.lock:
+            ring = self.rings.get(key)
+            if ring is None: return None
+            ts, rx, tx = ring.window(start, end)
+        rts, rin, rout = traffic_resample(ts, rx, tx, points)
+        return {"key": key, "start": start, "end": end, "count": len(ts), "ts": rts, "in": rin, "out": rout,
+                "stats": {"in": traffic_stats(rx), "out": traffic_stats(tx)}}
+
+acct = Accounting()
+
+@app.get("/api/acct/top")
+def api_acct_top(request: Request, n: int = 10, window: int = 300, kind: str = ""):
+    # kind 为 fwd（端口转发）或 wl（白名单条目），缺省为全部；按窗口内平均速率排序
     require_auth(request)
-    out=[]
-    for c in psutil.net_connections(kind='inet'):
+    return {"enabled": ACCT_ENABLED, "interval": ACCT_INTERVAL, "error": acct.error,
+            "items": acct.top(max(1, min(n, 1000)), max(ACCT_INTERVAL, window), kind)}
+
+@app.get("/api/acct/history")
+def api_acct_history(request: Request, key: str, start: float = 0, end: float = 0, points: int = TRAFFIC_POINTS):
+    require_auth(request)
+    end=end or time.time(); start=start or end-3600
+    res=acct.history(key, start, end, max(1, min(points, 10000)))
+    if res is None: raise HTTPException(404, "key")
+    return res
+
+# ---- 套接字枚举：NETLINK_SOCK_DIAG 直接向内核取 TCP/UDP 套接字（状态与端口在内核侧过滤），
+# 不可用时解析 /proc/net/{tcp,udp}{,6}；inode→PID 归属为独立的可选步骤并带缓存 ----
+SockAddr = namedtuple("SockAddr", "ip port")
+SockConn = namedtuple("SockConn", "fd family type laddr raddr status pid inode")
+TCP_STATES = {1: "ESTABLISHED", 2: "SYN_SENT", 3: "SYN_RECV", 4: "FIN_WAIT1", 5: "FIN_WAIT2", 6: "TIME_WAIT", 7: "CLOSE",
+              8: "CLOSE_WAIT", 9: "LAST_ACK", 10: "LISTEN", 11: "CLOSING", 12: "SYN_RECV"}
+TCP_STATE_BITS = {name: n for n, name in TCP_STATES.items() if n != 12}
+SOCK_PID_TTL = 5           # inode→PID 映射的重建间隔（秒）
+_NL_SOCK_DIAG, _NL_BY_FAMILY, _NL_DONE, _NL_ERROR = 4, 20, 3, 2
+_BC_JMP, _BC_S_GE, _BC_S_LE, _BC_D_GE, _BC_D_LE = 1, 2, 3, 4, 5
+
+def _diag_bytecode(lo, hi):
+    # 匹配 源端口∈[lo,hi] 或 目的端口∈[lo,hi]；每个比较占 8 字节（操作 + 端口），yes/no 为跳转字节数，
+    # 恰好跳到末尾即接受，越过末尾 4 字节即拒绝。内核校验沿 yes 链遍历，因此两个分支之间用
+    # 一条 JMP（yes=4 落到下一分支，执行时走 no 跳到末尾）连接，与 ss 的 OR 编译方式相同
+    op = lambda code, yes, no, port: struct.pack("=BBHBBH", code, yes, no, 0, 0, port)
+    return (op(_BC_S_GE, 8, 20, lo) + op(_BC_S_LE, 8, 12, hi) + struct.pack("=BBH", _BC_JMP, 4, 20)
+            + op(_BC_D_GE, 8, 20, lo) + op(_BC_D_LE, 8, 12, hi))
+
+def _diag_addr(family, raw):
+    return socket.inet_ntop(family, raw[:4] if family == socket.AF_INET else raw)
+
+def _diag_dump(family, proto, states, port):
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NL_SOCK_DIAG)
+    try:
+        req = struct.pack("=BBBBI", family, proto, 0, 0, states) + b"\0" * 48
+        if port:
+            bc = _diag_bytecode(*port); req += struct.pack("=HH", 4 + len(bc), 1) + bc
+        sock.sendall(struct.pack("=IHHII", 16 + len(req), _NL_BY_FAMILY, 0x301, 1, 0) + req)
+        stype = socket.SOCK_STREAM if proto == socket.IPPROTO_TCP else socket.SOCK_DGRAM; out = []
+        while True:
+            data = sock.recv(1 << 20); off = 0
+            while off + 16 <= len(data):
+                ln, typ = struct.unpack_from("=IH", data, off)
+                if typ == _NL_DONE: return out
+                if typ == _NL_ERROR: raise OSError(-struct.unpack_from("=i", data, off + 16)[0], "sock_diag")
+                fam, st = struct.unpack_from("=BB", data, off + 16)
+                sport, dport = struct.unpack_from(">HH", data, off + 20)
+                src = data[off + 24:off + 40]; dst = data[off + 40:off + 56]
+                inode = struct.unpack_from("=I", data, off + 84)[0]
+                laddr = SockAddr(_diag_addr(fam, src), sport)
+                raddr = SockAddr(_diag_addr(fam, dst), dport) if dport else ()
+                status = TCP_STATES.get(st, "NONE") if stype == socket.SOCK_STREAM else "NONE"
+                out.append(SockConn(-1, fam, stype, laddr, raddr, status, None, inode))
+                off += (ln + 3) & ~3
+    finally:
+        sock.close()
+
+def _proc_addr(family, hexaddr):
+    ip, port = hexaddr.split(":")
+    raw = bytes.fromhex(ip)
+    # /proc 中地址按 32 位字以主机字节序输出
+    raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    return SockAddr(socket.inet_ntop(family, raw), int(port, 16))
+
+def _proc_read(family, proto, states, port):
+    name = ("tcp" if proto == socket.IPPROTO_TCP else "udp") + ("6" if family == socket.AF_INET6 else "")
+    stype = socket.SOCK_STREAM if proto == socket.IPPROTO_TCP else socket.SOCK_DGRAM; out = []
+    try: f = open(f"/proc/net/{name}")
+    except OSError: return out
+    with f:
+        next(f, None)
+        for line in f:
+            parts = line.split()
+            if len(parts) < 10: continue
+            st = int(parts[3], 16)
+            if stype == socket.SOCK_STREAM and not (states >> st) & 1: continue
+            laddr = _proc_addr(family, parts[1]); raddr = _proc_addr(family, parts[2])
+            status = TCP_STATES.get(st, "NONE") if stype == socket.SOCK_STREAM else "NONE"
+            c = SockConn(-1, family, stype, laddr, raddr if raddr.port else (), status, None, int(parts[9]))
+            if not port or _port_in(c, port): out.append(c)
+    return out
+
+def _port_in(c, port):
+    return port[0] <= c.laddr.port <= port[1] or bool(c.raddr) and port[0] <= c.raddr.port <= port[1]
+
+class SockPids:
+    # inode→PID：遍历 /proc/*/fd 建立映射，SOCK_PID_TTL 内复用；未知 inode 不会触发额外的全量扫描
+    def __init__(self):
+        self.map = {}; self.ts = 0; self.lock = threading.Lock(); self.scans = 0
+
+    def get(self):
+        with self.lock:
+            if time.monotonic() - self.ts >= SOCK_PID_TTL:
+                m = {}
+                for pid in os.listdir("/proc"):
+                    if not pid.isdigit(): continue
+                    try:
+                        d = f"/proc/{pid}/fd"
+                        for fd in os.listdir(d):
+                            try: link = os.readlink(f"{d}/{fd}")
+                            except OSError: continue
+                            if link.startswith("socket:["): m[int(link[8:-1])] = int(pid)
+                    except OSError: pass
+                self.map = m; self.ts = time.monotonic(); self.scans += 1
+            return self.map
+
+sock_pids = SockPids()
+_sock_backend = {"netlink": True}
+
+def net_sockets(kind="inet", states=None, port=None, pids=True):
+    # 返回与 psutil.net_connections 同形的 SockConn 列表；states 为状态名集合（仅 TCP，指定时不返回 UDP），
+    # port 为端口或 (起, 止) 区间，匹配本地或远端端口；pids=False 时跳过 PID 归属
+    if isinstance(port, int): port = (port, port)
+    mask = 0xffffffff if not states else sum(1 << TCP_STATE_BITS[x] for x in states if x in TCP_STATE_BITS)
+    protos = {"inet": ("tcp", "udp"), "tcp": ("tcp",), "udp": ("udp",)}[kind]; out = []
+    for fam in (socket.AF_INET, socket.AF_INET6):
+        for pr in protos:
+            proto = socket.IPPROTO_TCP if pr == "tcp" else socket.IPPROTO_UDP
+            if pr == "udp" and states: continue
+            if _sock_backend["netlink"]:
+                try: out += _diag_dump(fam, proto, mask, port); continue
+                except OSError as e:
+                    if e.strerror != "sock_diag" or not port: _sock_backend["netlink"] = False
+                    else:
+                        # 内核不接受过滤字节码时改为全量导出后在本地过滤
+                        out += [c for c in _diag_dump(fam, proto, mask, None) if _port_in(c, port)]; continue
+            out += _proc_read(fam, proto, mask, port)
+    if pids:
+        m = sock_pids.get(); out = [c._replace(pid=m.get(c.inode)) for c in out]
+    return out
+
+# ---- 进程信息缓存：以 (pid, 创建时间) 为键，PID 复用时自动失效，进程退出后定期清除 ----
+PROC_SWEEP = 30
+PROC_NONE = {"name": "", "exe": "", "cmdline": "", "user": ""}
+
+class ProcCache:
+    def __init__(self):
+        self.data = {}; self.lock = threading.Lock(); self.swept = time.monotonic()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, pid):
+        if not pid: return PROC_NONE
         try:
-            pid=c.pid or 0; proc=psutil.Process(pid).name() if pid else ""
-        except: pid,proc=(c.pid or 0),""
-        laddr=f"{normalize_ip(c.laddr.ip)}:{c.laddr.port}" if c.laddr else ""
-        if c.raddr and c.raddr.ip:
-            rip=normalize_ip(c.raddr.ip); raddr=f"{rip}:{c.raddr.port}"; g=geo_both(rip)
-            out.append({"proc":proc,"pid":pid,"laddr":laddr,"raddr":raddr,"status":c.status,"local":g["local"],"online":g["online"],"flag":g["flag"],"geo":(g["online"] or g["local"])})
-        else:
-            out.append({"proc":proc,"pid":pid,"laddr":laddr,"raddr":"","status":c.status,"local":"","online":"","flag":"","geo":""})
-    return {"connections":out}
+            p = psutil.Process(pid); ct = p.create_time()   # 构造时只读取 /proc/<pid>/stat
+        except: return PROC_NONE
+        with self.lock:
+            item = self.data.get(pid)
+            if item and item[0] == ct: self.hits += 1; return item[1]
+        self.misses += 1; info = dict(PROC_NONE)
+        try:
+            with p.oneshot():
+                info["name"] = p.name()
+                for k, fn in (("exe", p.exe), ("cmdline", lambda: " ".join(p.cmdline())), ("user", p.username)):
+                    try: info[k] = fn()
+                    except: pass
+        except: return PROC_NONE
+        with self.lock: self.data[pid] = (ct, info)
+        self.sweep()
+        return info
+
+    def sweep(self, force=False):
+        if not force and time.monotonic() - self.swept < PROC_SWEEP: return
+        self.swept = time.monotonic(); live = set(psutil.pids())
+        with self.lock:
+            for pid in [x for x in self.data if x not in live]: del self.data[pid]; self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+proc_cache = ProcCache()
+
+# ---- 连接快照：定时采样并与上一快照比较，按版本号只下发变化部分；排序、过滤、分页在服务端完成 ----
+CONN_INTERVAL = 3          # 采样间隔（秒）
+CONN_IDLE = 60             # 超过该时间无人查询则暂停采样
+CONN_PAGE_MAX = 1000
+CONN_SORT_KEYS = ("proc", "pid", "proto", "laddr", "raddr", "status", "geo")
+
+class ConnSnapshot:
+    def __init__(self):
+        self.rows = {}; self.changed = {}; self.version = 0; self.ts = 0; self.accessed = 0
+        self.lock = None; self.task = None; self.sorted = (None, None)
+        self.views = OrderedDict()   # (视图参数, 版本) -> 当时该页的连接 id，用于计算分页增量
+        # 倒排索引，随快照一起重建：端口（本地或远端）-> 连接 id、有序端口表（区间查询）、PID -> 本地端口
+        self.by_port = {}; self.port_keys = []; self.by_pid = {}
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(CONN_INTERVAL)
+            if time.monotonic() - self.accessed < CONN_IDLE:
+                try: await self.refresh()
+                except: pass
+
+    def _sample(self):
+        conns = net_sockets(); procs = {}; rows = {}
+        proc_cache.sweep()
+        geo = geo_many(c.raddr.ip for c in conns if c.raddr and c.raddr.ip)
+        for c in conns:
+            pid = c.pid or 0
+            if pid not in procs: procs[pid] = proc_cache.get(pid)
+            proto = "tcp" if c.type == socket.SOCK_STREAM else "udp"
+            laddr = f"{normalize_ip(c.laddr.ip)}:{c.laddr.port}" if c.laddr else ""
+            row = {"proc": procs[pid]["name"], "pid": pid, "proto": proto, "laddr": laddr, "raddr": "", "status": c.status,
+                   "lport": c.laddr.port if c.laddr else 0, "rport": 0, "local": "", "online": "", "flag": "", "geo": ""}
+            if c.raddr and c.raddr.ip:
+                rip = normalize_ip(c.raddr.ip); g = geo[rip]
+                row.update(raddr=f"{rip}:{c.raddr.port}", rport=c.raddr.port, local=g["local"], online=g["online"], flag=g["flag"], geo=(g["online"] or g["local"]))
+            row["id"] = f"{proto}|{laddr}|{row['raddr']}|{pid}"
+            rows[row["id"]] = row
+        return rows
+
+    def _build(self):
+        rows = self._sample(); by_port = {}; by_pid = {}
+        for k, r in rows.items():
+            for port in {r["lport"], r["rport"]} - {0}: by_port.setdefault(port, []).append(k)
+            if r["pid"] and r["lport"]: by_pid.setdefault(r["pid"], set()).add(r["lport"])
+        return rows, (by_port, sorted(by_port), by_pid)
+
+    async def refresh(self):
+        if self.lock is None: self.lock = asyncio.Lock()
+        async with self.lock:
+            rows, index = await asyncio.to_thread(self._build)
+            added = rows.keys() - self.rows.keys(); removed = self.rows.keys() - rows.keys()
+            changed = [k for k in rows.keys() & self.rows.keys() if rows[k] != self.rows[k]]
+            if added or removed or changed:
+                self.version += 1
+                for k in added: self.changed[k] = self.version
+                for k in changed: self.changed[k] = self.version
+                for k in removed: self.changed.pop(k, None)
+                self.rows = rows; self.by_port, self.port_keys, self.by_pid = index
+            self.ts = time.monotonic()
+
+    async def ensure(self):
+        self.accessed = time.monotonic()
+        if time.monotonic() - self.ts > CONN_INTERVAL * 2: await self.refresh()
+
+    def view(self, sort, desc, q, status, proto):
+        key = (self.version, sort, desc, q, status, proto)
+        if self.sorted[0] == key: return self.sorted[1]
+        rows = self.rows.values()
+        if status: rows = [r for r in rows if r["status"] == status]
+        if proto: rows = [r for r in rows if r["proto"] == proto]
+        if q:
+            q = q.lower()
+            rows = [r for r in rows if q in f"{r['proc']} {r['pid']} {r['laddr']} {r['raddr']} {r['geo']}".lower()]
+        if sort == "pid": rows = sorted(rows, key=lambda r: r["pid"], reverse=desc)
+        else: rows = sorted(rows, key=lambda r: (r[sort] or "", r["id"]), reverse=desc)
+        self.sorted = (key, rows)
+        return rows
+
+    def port_rows(self, lo, hi):
+        # 只访问区间内实际出现的端口，耗时与匹配数成正比
+        keys = self.port_keys; i = bisect.bisect_left(keys, lo); j = bisect.bisect_right(keys, hi); seen = set(); out = []
+        for port in keys[i:j]:
+            for k in self.by_port[port]:
+                if k not in seen: seen.add(k); out.append(self.rows[k])
+        return out
+
+    def pid_rows(self, pid):
+        ports = self.by_pid.get(pid, ())
+        return [self.rows[k] for port in sorted(ports) for k in self.by_port[port] if self.rows[k]["pid"] == pid and self.rows[k]["lport"] == port]
+
+    def page(self, since, sort, desc, q, status, proto, offset, limit):
+        rows = self.view(sort, desc, q, status, proto); items = rows[offset:offset + limit]
+        ids = [r["id"] for r in items]; vkey = (sort, desc, q, status, proto, offset, limit)
+        before = self.views.get((vkey, since)) if since else None
+        self.views[(vkey, self.version)] = set(ids); self.views.move_to_end((vkey, self.version))
+        while len(self.views) > 64: self.views.popitem(last=False)
+        if before is None:
+            # 客户端版本过旧或视图改变：下发整页
+            return {"version": self.version, "full": True, "total": len(rows), "ids": ids, "rows": items, "removed": []}
+        fresh = [r for r in items if r["id"] not in before or self.changed.get(r["id"], 0) > since]
+        return {"version": self.version, "full": False, "total": len(rows), "ids": ids, "rows": fresh, "removed": list(before - set(ids))}
+
+conn_snap = ConnSnapshot()
+
+@app.get("/api/connections")
+async def api_connections(request: Request, since: int = 0, sort: str = "proc", desc: bool = False, q: str = "",
+                          status: str = "", proto: str = "", offset: int = 0, limit: int = 200):
+    # 响应中 ids 为当前页按顺序排列的连接 id，rows 仅包含自 since 版本以来新增或变化的行（full=True 时为整页），
+    # removed 为上一版本该页中已不在本页的 id
+    require_auth(request)
+    if sort not in CONN_SORT_KEYS: raise HTTPException(400, "sort")
+    await conn_snap.ensure()
+    return conn_snap.page(since, sort, desc, q.strip(), status, proto, max(0, offset), max(1, min(limit, CONN_PAGE_MAX)))
 
 # ---- Port search ----
 @app.get("/api/portsearch")
-def api_portsearch(request: Request, port: int):
+async def api_portsearch(request: Request, port: int, port_end: int = 0):
+    # 由连接快照的端口索引作答；port_end 给出时查询 [port, port_end] 区间
     require_auth(request)
+    hi=max(port, port_end or port)
+    if not (0 < port <= 65535 and hi <= 65535): raise HTTPException(400, "port")
+    await conn_snap.ensure()
     res=[]
-    for c in psutil.net_connections(kind='inet'):
-        if (c.laddr and c.laddr.port==port) or (c.raddr and c.raddr.port==port):
-            try:
-                pid=c.pid or 0; p=psutil.Process(pid); name=p.name() if pid else ""; exe=p.exe() if pid else ""
-            except: pid,name,exe=(c.pid or 0),"",""
-            laddr=f"{normalize_ip(c.laddr.ip)}:{c.laddr.port}" if c.laddr else ""
-            raddr=f"{normalize_ip(c.raddr.ip)}:{c.raddr.port}" if c.raddr else ""
-            res.append({"pid":pid,"proc":name,"exe":exe,"laddr":laddr,"raddr":raddr,"status":c.status})
-    return {"port":port,"results":res}
+    for r in conn_snap.port_rows(port, hi):
+        info=proc_cache.get(r["pid"])
+        res.append({"pid":r["pid"],"proc":info["name"],"exe":info["exe"],"cmdline":info["cmdline"],"user":info["user"],
+                    "proto":r["proto"],"laddr":r["laddr"],"raddr":r["raddr"],"status":r["status"]})
+    return {"port":port,"port_end":hi,"results":res}
+
+@app.get("/api/pid/{pid}/ports")
+async def api_pid_ports(request: Request, pid: int):
+    require_auth(request)
+    await conn_snap.ensure()
+    rows=conn_snap.pid_rows(pid); info=proc_cache.get(pid)
+    return {"pid":pid,"proc":info["name"],"exe":info["exe"],"cmdline":info["cmdline"],"user":info["user"],
+            "ports":sorted({r["lport"] for r in rows}),
+            "sockets":[{"proto":r["proto"],"laddr":r["laddr"],"raddr":r["raddr"],"status":r["status"]} for r in rows]}
 
 # ---- ICMP/TCP/UDP & Scan ----
 def resolve_host(host):
     try: return socket.gethostbyname(host)
     except: return ""
+
+# 异步解析：经 loop.getaddrinfo（遵循 /etc/hosts 与 nsswitch）取得全部 IPv4/IPv6 地址，结果按 TTL 缓存，
+# 同一主机名的并发请求合并为一次查询；getaddrinfo 不提供记录 TTL，因此使用固定有效期
+DNS_TTL = 300
+DNS_NEG_TTL = 30
+DNS_CACHE_MAX = 4096
+
+class DnsCache:
+    def __init__(self):
+        self.data = OrderedDict(); self.inflight = {}; self.hits = self.misses = 0
+
+    async def resolve(self, host):
+        # 返回地址列表（按 getaddrinfo 的优先顺序去重）；IP 字面量直接返回，解析失败返回空列表
+        try: return [str(ipaddress.ip_address(host.strip("[]")))]
+        except ValueError: pass
+        item = self.data.get(host)
+        if item and item[0] > time.monotonic(): self.hits += 1; self.data.move_to_end(host); return item[1]
+        self.misses += 1
+        fut = self.inflight.get(host)
+        if fut is None:
+            fut = self.inflight[host] = asyncio.ensure_future(self._lookup(host))
+            fut.add_done_callback(lambda _: self.inflight.pop(host, None))
+        return await asyncio.shield(fut)
+
+    async def _lookup(self, host):
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            addrs = list(dict.fromkeys(normalize_ip(i[4][0]) for i in infos))
+        except (socket.gaierror, UnicodeError):
+            addrs = []
+        self.data[host] = (time.monotonic() + (DNS_TTL if addrs else DNS_NEG_TTL), addrs); self.data.move_to_end(host)
+        while len(self.data) > DNS_CACHE_MAX: self.data.popitem(last=False)
+        return addrs
+
+    async def resolve_many(self, hosts):
+        res = await asyncio.gather(*(self.resolve(h) for h in dict.fromkeys(hosts)))
+        return dict(zip(dict.fromkeys(hosts), res))
+
+    def stats(self):
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses, "inflight": len(self.inflight)}
+
+dns_cache = DnsCache()
+
+async def resolve_ip(host):
+    addrs = await dns_cache.resolve(host)
+    return addrs[0] if addrs else ""
+
 def icmp_ping(host, count=3, timeout=1):
     ip = resolve_host(host) or host
-    cmd = f"ping -n -c {count} -W {timeout} {shlex.quote(host)}"
+    cmd = ["ping", "-n", "-c", str(count), "-W", str(timeout), host]
     try:
-        res = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=max(timeout*count+2, 5))
+        res = subprocess.run(cmd, capture_output=True, text=True, timeout=max(timeout*count+2, 5))
         out = res.stdout + res.stderr
         ok = (res.returncode == 0)
         avg = None
@@ -618,49 +2094,209 @@ def icmp_ping(host, count=3, timeout=1):
     except Exception as e:
         return {"host": host, "ip": ip, "ok": False, "error": str(e)}
 
-async def tcp_probe(host, port, timeout=1.0):
-    loop = asyncio.get_event_loop(); ip = resolve_host(host) or host; t0=loop.time()
+# ICMP 引擎：每个地址族共用一个 ICMP 套接字，所有主机的回显请求并发发送，按序号（raw 模式再加标识）匹配应答。
+# 优先使用免特权的 SOCK_DGRAM ping 套接字（受 net.ipv4.ping_group_range 限制），否则用 raw 套接字（需 CAP_NET_RAW），
+# 都不可用时退回调用 ping 命令
+ICMP_INTERVAL = 0.2        # 同一主机相邻两次回显请求的间隔（秒）
+
+def icmp_checksum(data):
+    if len(data) % 2: data += b"\0"
+    s = sum(struct.unpack(f"!{len(data) // 2}H", data)); s = (s >> 16) + (s & 0xffff); s += s >> 16
+    return ~s & 0xffff
+
+class IcmpEngine:
+    def __init__(self):
+        self.socks = {}; self.waiters = {}; self.seq = 0; self.ident = os.getpid() & 0xffff
+
+    def _sock(self, fam):
+        if fam in self.socks: return self.socks[fam]
+        proto = socket.IPPROTO_ICMP if fam == socket.AF_INET else socket.IPPROTO_ICMPV6
+        try: sock = socket.socket(fam, socket.SOCK_DGRAM, proto); raw = False
+        except OSError: sock = socket.socket(fam, socket.SOCK_RAW, proto); raw = True
+        sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_read, fam)
+        self.socks[fam] = (sock, raw)
+        return self.socks[fam]
+
+    def _on_read(self, fam):
+        sock, raw = self.socks[fam]; now = asyncio.get_running_loop().time()
+        while True:
+            try: data, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError): return
+            except OSError: continue
+            # IPv4 raw 套接字收到的数据带 IP 头；dgram 套接字与 IPv6 只有 ICMP 部分
+            if raw and fam == socket.AF_INET: data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < 8 or data[0] != (0 if fam == socket.AF_INET else 129): continue
+            ident, seq = struct.unpack_from("!HH", data, 4)
+            if raw and ident != self.ident: continue
+            fut = self.waiters.get((fam, seq))
+            if fut and not fut.done() and fut.ip == addr[0]: fut.set_result(now)
+
+    async def _echo(self, fam, ip, timeout):
+        sock, raw = self._sock(fam); loop = asyncio.get_running_loop()
+        self.seq = (self.seq + 1) & 0xffff; seq = self.seq; key = (fam, seq)
+        fut = loop.create_future(); fut.ip = ip; self.waiters[key] = fut
+        try:
+            typ = 8 if fam == socket.AF_INET else 128
+            pkt = struct.pack("!BBHHH", typ, 0, 0, self.ident, seq) + os.urandom(16)
+            # dgram 套接字由内核填写标识与校验和，ICMPv6 校验和总由内核计算
+            if fam == socket.AF_INET: pkt = pkt[:2] + struct.pack("!H", icmp_checksum(pkt)) + pkt[4:]
+            t0 = loop.time(); sock.sendto(pkt, (ip, 0))
+            return (await asyncio.wait_for(fut, timeout) - t0) * 1000.0
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            self.waiters.pop(key, None)
+
+    async def ping(self, host, count=3, timeout=1.0, interval=ICMP_INTERVAL, ip=None):
+        ip = ip or await resolve_ip(host)
+        try: fam = socket.AF_INET6 if ipaddress.ip_address(ip).version == 6 else socket.AF_INET
+        except ValueError: return {"host": host, "ip": "", "ok": False, "error": "resolve failed"}
+        try: self._sock(fam)
+        except OSError: return dict(await asyncio.to_thread(icmp_ping, ip, count, max(1, int(timeout))), host=host)
+        async def one(i):
+            await asyncio.sleep(i * interval); return await self._echo(fam, ip, timeout)
+        rtts = [x for x in await asyncio.gather(*(one(i) for i in range(count))) if x is not None]
+        res = {"host": host, "ip": ip, "ok": bool(rtts), "avg_ms": None, "sent": count, "received": len(rtts),
+               "loss": round(1 - len(rtts) / count, 4) if count else 0}
+        if rtts:
+            # 抖动取相邻两次往返时间差的平均值
+            jit = sum(abs(a - b) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1) if len(rtts) > 1 else 0.0
+            res.update(avg_ms=sum(rtts) / len(rtts), min_ms=min(rtts), max_ms=max(rtts), jitter_ms=jit)
+        return res
+
+icmp_engine = IcmpEngine()
+
+# 扫描引擎：固定大小的滑动并发窗口（完成一个补一个），按主机统计 RTT 自适应缩短超时，结果按完成顺序产出
+SCAN_CONCURRENCY = 256
+SCAN_CONCURRENCY_MAX = 2048
+SCAN_TIMEOUT_FLOOR = 0.25  # 自适应超时下限（秒）
+
+class HostRtt:
+    # 每台主机按 RFC 6298 维护 SRTT/RTTVAR；连接成功与被拒绝（RST）都是有效的往返样本
+    def __init__(self, timeout):
+        self.timeout = timeout; self.hosts = {}
+
+    def sample(self, host, rtt):
+        h = self.hosts.get(host)
+        if h is None: self.hosts[host] = [rtt, rtt / 2]; return
+        h[1] = 0.75 * h[1] + 0.25 * abs(h[0] - rtt); h[0] = 0.875 * h[0] + 0.125 * rtt
+
+    def timeout_for(self, host):
+        h = self.hosts.get(host)
+        if h is None: return self.timeout
+        return min(self.timeout, max(SCAN_TIMEOUT_FLOOR, 2 * (h[0] + 4 * h[1])))
+
+async def tcp_probe(host, port, timeout=1.0, rtt=None, ip=None):
+    # state: open（完成握手）/ closed（被拒绝）/ filtered（超时或不可达）；ip 为已解析的地址，直接连接
+    ip = ip or await resolve_ip(host)
+    if not ip: return {"host":host,"ip":"","port":port,"open":False,"state":"error","latency_ms":0.0,"error":"resolve failed"}
+    loop = asyncio.get_event_loop(); t0=loop.time()
+    limit = rtt.timeout_for(host) if rtt else timeout; state = "filtered"
     try:
-        fut=asyncio.open_connection(host, port)
-        reader, writer = await asyncio.wait_for(fut, timeout=timeout)
-        dt=(loop.time()-t0)*1000.0; writer.close(); 
+        fut=asyncio.open_connection(ip, port)
+        reader, writer = await asyncio.wait_for(fut, timeout=limit)
+        dt=(loop.time()-t0)*1000.0; writer.close(); state = "open"
         try: await writer.wait_closed()
         except: pass
-        return {"host":host,"ip":ip,"port":port,"open":True,"latency_ms":dt}
+    except ConnectionRefusedError:
+        dt=(loop.time()-t0)*1000.0; state = "closed"
     except Exception:
-        dt=(loop.time()-t0)*1000.0; return {"host":host,"ip":ip,"port":port,"open":False,"latency_ms":dt}
-
-async def udp_probe(host, port, timeout=1.0):
-    loop=asyncio.get_event_loop(); ip=resolve_host(host) or host; t0=loop.time()
-    try:
-        transport, protocol = await asyncio.wait_for(loop.create_datagram_endpoint(lambda: asyncio.DatagramProtocol(), remote_addr=(host, port)), timeout=timeout)
-        try:
-            transport.sendto(b''); await asyncio.sleep(timeout)
-        finally:
-            transport.close()
         dt=(loop.time()-t0)*1000.0
-        return {"host":host,"ip":ip,"port":port,"status":"no_response","latency_ms":dt}
+    if rtt and state != "filtered": rtt.sample(host, dt / 1000.0)
+    return {"host":host,"ip":ip,"port":port,"open":state=="open","state":state,"latency_ms":dt}
+
+async def scan_iter(jobs, concurrency=SCAN_CONCURRENCY, tick=None):
+    # jobs 为协程工厂的可迭代对象；任一时刻最多 concurrency 个探测在途，结果按完成顺序产出。
+    # 给出 tick 时，若 tick 秒内没有探测完成则产出 None，供调用方发送进度。
+    # 调用方提前结束迭代（aclose/断开）时取消所有在途探测
+    jobs = iter(jobs); pending = set()
+    try:
+        while True:
+            while len(pending) < concurrency:
+                job = next(jobs, None)
+                if job is None: break
+                pending.add(asyncio.ensure_future(job()))
+            if not pending: return
+            done, pending = await asyncio.wait(pending, timeout=tick, return_when=asyncio.FIRST_COMPLETED)
+            if not done: yield None
+            for t in done: yield t.result()
+    finally:
+        for t in pending: t.cancel()
+        if pending: await asyncio.gather(*pending, return_exceptions=True)
+
+# UDP 探测载荷：按端口发送对应协议的最小合法请求，使服务给出应答；未列出的端口发送空数据报
+UDP_PAYLOADS = {
+    53: ("dns", bytes.fromhex("fe4b000000010000000000000000020001")),
+    69: ("tftp", b"\x00\x01fwweb-probe\x00octet\x00"),
+    111: ("rpcbind", struct.pack(">10I", 0x66770111, 0, 2, 100000, 2, 0, 0, 0, 0, 0)),
+    123: ("ntp", b"\x1b" + b"\x00" * 47),
+    137: ("netbios-ns", bytes.fromhex("fe4c00000001000000000000") + b"\x20CKAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\x00\x00\x21\x00\x01"),
+    161: ("snmp", bytes.fromhex("302902010004067075626c6963a01c020466770161020100020100300e300c06082b060102010101000500")),
+    389: ("cldap", bytes.fromhex("3025020101632004000a01000a0100020100020100010100870b6f626a656374436c6173733000")),
+    1900: ("ssdp", b"M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: \"ssdp:discover\"\r\nMX: 1\r\nST: ssdp:all\r\n\r\n"),
+    2049: ("nfs", struct.pack(">10I", 0x66772049, 0, 2, 100003, 3, 0, 0, 0, 0, 0)),
+    3478: ("stun", bytes.fromhex("000100002112a442") + b"fwweb-probe!"),
+    5060: ("sip", b"OPTIONS sip:nm SIP/2.0\r\nVia: SIP/2.0/UDP nm;branch=z9hG4bK-fwweb\r\nFrom: <sip:nm@nm>;tag=fwweb\r\n"
+                  b"To: <sip:nm2@nm2>\r\nCall-ID: fwweb-probe\r\nCSeq: 1 OPTIONS\r\nMax-Forwards: 70\r\nContent-Length: 0\r\n\r\n"),
+    11211: ("memcached", b"\x00\x01\x00\x00\x00\x01\x00\x00stats\r\n"),
+}
+
+# UDP 模式的 common 端口：去掉 DHCP 67/68（服务端按 RFC 2131 回复到客户端 68 端口或广播，到不了探测用的临时端口，
+# 无论载荷如何都只能得到 open|filtered），补上有协议载荷的 UDP 服务
+UDP_COMMON_PORTS = sorted(set(COMMON_PORTS) - {67, 68} | set(UDP_PAYLOADS))
+
+class UdpReply(asyncio.DatagramProtocol):
+    # 已连接的 UDP 套接字：收到数据即 open；ICMP 端口不可达以 ECONNREFUSED 报告为 closed，其它 ICMP 不可达为 filtered
+    def __init__(self):
+        self.fut = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.fut.done(): self.fut.set_result(("open", data))
+
+    def error_received(self, exc):
+        if not self.fut.done(): self.fut.set_result(("closed" if isinstance(exc, ConnectionRefusedError) else "filtered", exc))
+
+async def udp_probe(host, port, timeout=1.0, ip=None):
+    # status: open（收到应答）/ closed（端口不可达）/ filtered（其它不可达）/ open|filtered（超时无应答）；
+    # 收到应答或 ICMP 错误立即返回，超时过半仍无结果时重发一次以应对丢包
+    ip = ip or await resolve_ip(host)
+    if not ip: return {"host":host,"ip":"","port":port,"status":"error","latency_ms":0.0,"error":"resolve failed"}
+    loop=asyncio.get_event_loop(); t0=loop.time(); service, payload = UDP_PAYLOADS.get(port, ("", b""))
+    res = {"host":host,"ip":ip,"port":port,"service":service}
+    try:
+        # 自行创建并连接套接字后直接 send：asyncio 的 transport.sendto 会丢弃空数据报
+        sock = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_DGRAM); sock.setblocking(False)
+        try: sock.connect((ip, port)); transport, proto = await loop.create_datagram_endpoint(UdpReply, sock=sock)
+        except: sock.close(); raise
     except Exception as e:
-        dt=(loop.time()-t0)*1000.0
-        return {"host":host,"ip":ip,"port":port,"status":"error","latency_ms":dt,"error":str(e)}
-
-@app.post("/api/scan")
-async def api_scan(request: Request):
-    require_auth(request)
-    body = await request.json()
+        return dict(res, status="error", latency_ms=(loop.time()-t0)*1000.0, error=str(e))
+    try:
+        status, data = "open|filtered", None
+        for half in (True, False):
+            try: sock.send(payload)
+            except OSError as e: proto.error_received(e)
+            wait = timeout / 2 if half else timeout - (loop.time() - t0)
+            try: status, data = await asyncio.wait_for(asyncio.shield(proto.fut), timeout=max(wait, 0)); break
+            except asyncio.TimeoutError: pass
+    finally:
+        transport.close()
+    res.update(status=status, latency_ms=(loop.time()-t0)*1000.0)
+    if isinstance(data, bytes): res["reply_bytes"] = len(data)
+    elif status == "filtered": res["error"] = str(data)
+    return res
+
+def scan_params(body):
     hosts = body.get("hosts") or []
     mode = (body.get("mode") or "icmp").lower()
     ports_raw = body.get("ports") or ""
     timeout = float(body.get("timeout") or 1.0)
+    concurrency = max(1, min(int(body.get("concurrency") or SCAN_CONCURRENCY), SCAN_CONCURRENCY_MAX))
     norm_hosts = [ (h or "").strip() for h in hosts if (h or "").strip() ][:64]
-    if not norm_hosts: return {"error":"no hosts"}
-    if mode == "icmp":
-        results=[icmp_ping(h, count=3, timeout=int(timeout)) for h in norm_hosts]
-        return {"mode":"icmp","results":results}
     ports=[]
     if isinstance(ports_raw,str):
         if ports_raw.strip().lower()=="common" or ports_raw.strip()=="":
-            ports = COMMON_PORTS[:]
+            ports = (UDP_COMMON_PORTS if mode=="udp" else COMMON_PORTS)[:]
         else:
             for tok in ports_raw.replace("，",",").split(","):
                 tok=tok.strip()
@@ -674,21 +2310,87 @@ async def api_scan(request: Request):
                 if 1<=p<=65535: ports.append(p)
             except: pass
     ports=sorted(set(ports))[:256]
-    tasks=[]
+    return norm_hosts, mode, ports, timeout, concurrency
+
+def scan_jobs(mode, targets, ports, timeout):
+    # targets 为 (主机名, 已解析地址) 列表；端口在外层、主机在内层交错排列，避免同一主机的探测集中在窗口内
+    if mode=="icmp":
+        return (functools.partial(icmp_engine.ping, h, 3, timeout, ip=ip) for h, ip in targets)
     if mode=="tcp":
-        for h in norm_hosts:
-            for p in ports: tasks.append(tcp_probe(h,p,timeout=timeout))
-    elif mode=="udp":
-        for h in norm_hosts:
-            for p in ports: tasks.append(udp_probe(h,p,timeout=timeout))
-    else:
-        return {"error":"mode not supported"}
-    results=[]
-    if tasks:
-        step=128
-        for i in range(0,len(tasks),step):
-            results += await asyncio.gather(*tasks[i:i+step])
-    return {"mode":mode,"results":results}
+        rtt=HostRtt(timeout)
+        return (functools.partial(tcp_probe, h, p, timeout, rtt, ip) for p in ports for h, ip in targets)
+    if mode=="udp":
+        return (functools.partial(udp_probe, h, p, timeout, ip) for p in ports for h, ip in targets)
+    return None
+
+async def scan_targets(hosts):
+    # 每个主机名只解析一次；探测使用首选地址，全部地址随结果返回，解析失败的主机单独列出
+    resolved = await dns_cache.resolve_many(hosts)
+    targets = [(h, resolved[h][0]) for h in hosts if resolved[h]]
+    return targets, {h: resolved[h] for h in hosts}, [h for h in hosts if not resolved[h]]
+
+SCAN_TICK = 0.5            # 流式扫描的进度帧间隔（秒）
+scans = {}                 # 进行中的流式扫描：id -> 取消事件
+
+def scan_open(r):
+    return bool(r.get("open") or r.get("ok") or r.get("status") == "open")
+
+async def scan_frames(scan_id, mode, hosts, ports, timeout, concurrency, cancel):
+    # 帧类型：start、result（每个探测一帧）、progress（定期）、done / cancelled
+    targets, resolved, unresolved = await scan_targets(hosts)
+    jobs = scan_jobs(mode, targets, ports, timeout); total = len(targets) * (1 if mode == "icmp" else len(ports))
+    yield {"type": "start", "id": scan_id, "mode": mode, "total": total, "resolved": resolved, "unresolved": unresolved}
+    done = opened = 0; last = time.monotonic(); it = scan_iter(jobs, concurrency, tick=SCAN_TICK)
+    try:
+        async for r in it:
+            if cancel.is_set(): break
+            if r is not None:
+                done += 1; opened += scan_open(r); yield {"type": "result", **r}
+            if r is None or time.monotonic() - last >= SCAN_TICK:
+                last = time.monotonic(); yield {"type": "progress", "done": done, "total": total, "open": opened}
+        yield {"type": "cancelled" if cancel.is_set() else "done", "done": done, "total": total, "open": opened}
+    finally:
+        await it.aclose()
+
+@app.post("/api/scan")
+async def api_scan(request: Request, stream: str = ""):
+    # stream=ndjson|sse（或 Accept: application/x-ndjson / text/event-stream）时边扫描边返回；
+    # 客户端断开或调用 /api/scan/{id}/cancel 即停止，在途探测随之取消
+    require_auth(request)
+    norm_hosts, mode, ports, timeout, concurrency = scan_params(await request.json())
+    if not norm_hosts: return {"error":"no hosts"}
+    if mode not in ("icmp", "tcp", "udp"): return {"error":"mode not supported"}
+    accept = request.headers.get("accept", "")
+    stream = stream or ("sse" if "text/event-stream" in accept else "ndjson" if "application/x-ndjson" in accept else "")
+    if stream:
+        scan_id = base64.urlsafe_b64encode(os.urandom(6)).decode(); cancel = asyncio.Event(); scans[scan_id] = cancel
+        async def gen():
+            try:
+                async for frame in scan_frames(scan_id, mode, norm_hosts, ports, timeout, concurrency, cancel):
+                    data = json.dumps(frame, ensure_ascii=False)
+                    yield f"event: {frame['type']}\ndata: {data}\n\n" if stream == "sse" else data + "\n"
+                    if frame["type"] == "progress" and await request.is_disconnected(): break
+            finally:
+                scans.pop(scan_id, None)
+        return StreamingResponse(gen(), media_type="text/event-stream" if stream == "sse" else "application/x-ndjson",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    targets, resolved, unresolved = await scan_targets(norm_hosts)
+    results=[r async for r in scan_iter(scan_jobs(mode, targets, ports, timeout), concurrency)]
+    order={h:i for i,h in enumerate(norm_hosts)}
+    results.sort(key=lambda r:(order[r["host"]], r.get("port", 0)))
+    return {"mode":mode,"results":results,"resolved":resolved,"unresolved":unresolved}
+
+@app.post("/api/scan/{scan_id}/cancel")
+def api_scan_cancel(request: Request, scan_id: str):
+    require_auth(request)
+    cancel=scans.get(scan_id)
+    if cancel is None: raise HTTPException(404, "scan")
+    cancel.set(); return {"status":"ok"}
+
+@app.get("/api/dns/stats")
+def api_dns_stats(request: Request):
+    require_auth(request)
+    return dns_cache.stats()
 
 # ---- Speedtest ----
 @app.get("/api/speedtest/down")
@@ -1,9 +1,19 @@
-import os, json, subprocess, sys
+import os, json, subprocess, sys, sqlite3
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 STATE_FILE = os.path.join(APP_DIR, "state", "state.json")
+DB_FILE = os.path.join(APP_DIR, "state", "firewall_web.db")
 DEFAULT_PORT = 48080
 def load_port():
+    # 优先读取 SQLite 中的设置；尚未迁移时回退到旧版 state.json
+    try:
+        db=sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True)
+        try: row=db.execute("SELECT value FROM settings WHERE key='panel_port'").fetchone()
+        finally: db.close()
+        if row:
+            p=int(json.loads(row[0]))
+            if 1<=p<=65535: return p
+    except: pass
     try:
         with open(STATE_FILE,"r") as f:
             s=json.load(f)
@@ -1,4 +1,6 @@
-let connData = [], connSortKey='proc', connSortAsc=true, stopFlag=false;
+let connSortKey='proc', connSortAsc=true, stopFlag=false;
+// 连接表增量状态：服务端按版本号只返回变化的行，行节点按 id 复用
+let connVersion=0, connView='', connOffset=0, connLimit=200, connTotal=0, connRows=new Map(), connNodes=new Map();
 
 function human(n){
   if (n < 1024) return n + ' B';
@@ -50,28 +52,55 @@ async function loadAll(){
     document.getElementById('speed').innerText = humanRate(t.rx_rate) + " ↓ / " + humanRate(t.tx_rate) + " ↑";
     document.getElementById('ifstat').innerText = t.ifaces.map(x=>`${x.iface}: ${human(x.rx)} ↓ / ${human(x.tx)} ↑`).join('\n');
   }catch(e){ showErr('获取流量信息失败'); }
+  try{
+    let a = await (await fetch('/api/acct/top?n=5&window=300', {credentials:'include'})).json();
+    document.getElementById('talkers').innerText = (a.items||[]).length ? a.items.map(x=>
+      `${x.kind==='fwd'?'转发':'白名单'} ${x.target}: ${humanRate(x.in_rate)} ↓ / ${humanRate(x.out_rate)} ↑`).join('\n') : (a.enabled ? '（暂无数据）' : '（未检测到 iptables）');
+  }catch(e){}
 
+  await loadConn();
+  await loadForwards();
+}
+function connQuery(){
+  const q=(document.getElementById('connq')||{}).value||'';
+  return new URLSearchParams({sort:connSortKey, desc:String(!connSortAsc), q:q.trim(), offset:String(connOffset), limit:String(connLimit)}).toString();
+}
+async function loadConn(){
   try{
-    let c = await (await fetch('/api/connections', {credentials:'include'})).json();
-    connData = c.connections||[]; renderConn();
+    const view=connQuery();
+    if (view!==connView){ connView=view; connVersion=0; }
+    let res = await fetch('/api/connections?'+view+'&since='+connVersion, {credentials:'include'}); if(!res.ok) throw 0;
+    let c = await res.json();
+    if (connQuery()!==view) return;   // 请求期间视图已改变，丢弃过期结果
+    if (c.full) connRows.clear();
+    (c.removed||[]).forEach(id=>connRows.delete(id));
+    (c.rows||[]).forEach(r=>connRows.set(r.id, r));
+    connVersion=c.version; connTotal=c.total; renderConn(c.ids||[], c.full ? null : new Set((c.rows||[]).map(r=>r.id)));
   }catch(e){ showErr('获取连接信息失败'); }
-  await loadForwards();
 }
-function sortBy(k){ if (connSortKey===k) connSortAsc=!connSortAsc; else {connSortKey=k; connSortAsc=true;} renderConn(); }
-function renderConn(){
-  let tbody=document.getElementById('connbody'); if(!tbody) return;
-  let data=connData.slice();
-  data.sort((a,b)=>{
-    let A=a[connSortKey]||'', B=b[connSortKey]||'';
-    if (typeof A === 'number' && typeof B === 'number') return (connSortAsc?A-B:B-A);
-    return (connSortAsc? (''+A).localeCompare(''+B):( ''+B).localeCompare(''+A));
-  });
-  tbody.innerHTML=data.map(x=>`<tr>
-    <td>${x.proc||''}</td><td>${x.pid||''}</td>
+function sortBy(k){ if (connSortKey===k) connSortAsc=!connSortAsc; else {connSortKey=k; connSortAsc=true;} connOffset=0; loadConn(); }
+function connFilter(){ connOffset=0; loadConn(); }
+function connPage(d){ const n=connOffset+d*connLimit; if(n<0 || n>=connTotal) return; connOffset=n; loadConn(); }
+function connRow(x){
+  return `<td>${x.proc||''}</td><td>${x.pid||''}</td>
     <td class="mono">${x.laddr||''}</td><td class="mono">${x.raddr||''}</td>
     <td>${x.status||''}</td>
-    <td>${x.flag?'<span class="flag">'+x.flag+'</span> ':''}<div>${x.local||''}</div><div class="muted">${x.online||''}</div></td>
-  </tr>`).join('');
+    <td>${x.flag?'<span class="flag">'+x.flag+'</span> ':''}<div>${x.local||''}</div><div class="muted">${x.online||''}</div></td>`;
+}
+// 只重绘变化的行（dirty 为 null 时整页重绘），其余行节点原样复用，仅按 ids 调整顺序
+function renderConn(ids, dirty){
+  let tbody=document.getElementById('connbody'); if(!tbody) return;
+  const keep=new Set(ids);
+  for (const [id, tr] of connNodes){ if(!keep.has(id)){ tr.remove(); connNodes.delete(id); } }
+  ids.forEach((id, i)=>{
+    let tr=connNodes.get(id), x=connRows.get(id); if(!x) return;
+    if(!tr){ tr=document.createElement('tr'); connNodes.set(id, tr); tr.innerHTML=connRow(x); }
+    else if(!dirty || dirty.has(id)) tr.innerHTML=connRow(x);
+    if (tbody.children[i]!==tr) tbody.insertBefore(tr, tbody.children[i]||null);
+  });
+  for (const id of connRows.keys()){ if(!keep.has(id)) connRows.delete(id); }
+  const info=document.getElementById('connpage');
+  if(info) info.textContent = connTotal ? `${connOffset+1}-${Math.min(connOffset+connLimit, connTotal)} / ${connTotal}` : '0';
 }
 
 async function strictify(){
@@ -163,10 +192,11 @@ async function portSearch(){
   try{
     let p = document.getElementById('searchport').value.trim();
     if(!p){ toast('请输入端口'); return; }
-    let res = await fetch('/api/portsearch?port='+encodeURIComponent(p), {credentials:'include'});
+    let [lo, hi] = p.split('-').map(x=>x.trim());
+    let res = await fetch('/api/portsearch?port='+encodeURIComponent(lo)+(hi?'&port_end='+encodeURIComponent(hi):''), {credentials:'include'});
     if(!res.ok){ showErr('查询端口失败'); return; }
     let d = await res.json();
-    let lines = ['端口 '+d.port+' 的占用：'];
+    let lines = ['端口 '+(d.port_end!==d.port ? d.port+'-'+d.port_end : d.port)+' 的占用：'];
     if(!d.results || d.results.length===0){ lines.push('无占用'); }
     else{
       d.results.forEach(x=>{
@@ -0,0 +1,15 @@
+# firewall_web 在导入时会在脚本目录下创建 state/ 与日志文件，测试时复制到临时目录再导入，不污染工作区
+import os, sys, shutil, importlib.util
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="session")
+def fw(tmp_path_factory):
+    d = tmp_path_factory.mktemp("app")
+    shutil.copy(os.path.join(ROOT, "firewall_web.py"), d)
+    shutil.copytree(os.path.join(ROOT, "static"), d / "static")
+    spec = importlib.util.spec_from_file_location("firewall_web", d / "firewall_web.py")
+    mod = importlib.util.module_from_spec(spec); sys.modules["firewall_web"] = mod
+    spec.loader.exec_module(mod)
+    return mod
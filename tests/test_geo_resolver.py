@@ -0,0 +1,54 @@
+# 在线地理解析：ip-api 批量接口的桩服务（经 FW_GEO_ONLINE_URL 的同名模块变量注入）
+import json, time, asyncio, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+class Stub(BaseHTTPRequestHandler):
+    calls = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        Stub.calls.append([x["query"] for x in body])
+        out = json.dumps([{"query": x["query"], "status": "success", "country": "测试", "countryCode": "CN"} for x in body]).encode()
+        self.send_response(200); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(out)))
+        self.end_headers(); self.wfile.write(out)
+
+    def log_message(self, *a): pass
+
+@pytest.fixture
+def stub(fw, monkeypatch):
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Stub); Stub.calls = []
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    monkeypatch.setattr(fw, "GEO_ONLINE_URL", f"http://127.0.0.1:{srv.server_port}")
+    yield Stub.calls
+    srv.shutdown()
+
+def resolve(fw, monkeypatch, ips):
+    async def main():
+        monkeypatch.setattr(fw.cmd_runner, "loop", asyncio.get_running_loop())
+        r = fw.GeoResolver(); r.submit(ips)
+        for _ in range(500):
+            await asyncio.sleep(0.01)
+            if not r.running and not r.tasks: break
+        return r
+    return asyncio.run(main())
+
+def test_batch_split(fw, monkeypatch, stub):
+    ips = [f"8.{i}.0.1" for i in range(150)]
+    r = resolve(fw, monkeypatch, ips)
+    assert sorted(len(c) for c in stub) == [50, 100]  # 两个批次并发发出，到达顺序不定
+    assert sorted(ip for c in stub for ip in c) == sorted(ips)
+    assert r.stats()["resolved"] == 150 and r.stats()["failed"] == 0
+    assert fw.geo_cache_online.get("8.149.0.77")["cc"] == "CN"
+
+def test_same_prefix_queried_once(fw, monkeypatch, stub):
+    resolve(fw, monkeypatch, [f"9.9.9.{i}" for i in range(1, 200)])
+    assert len(stub) == 1 and len(stub[0]) == 1
+
+def test_rate_limiter_paces_after_burst(fw):
+    async def main():
+        lim = fw.RateLimiter(20, burst=2); t0 = time.monotonic()
+        for _ in range(6): await lim.acquire()
+        return time.monotonic() - t0
+    # 突发 2 个之后每 50ms 一个令牌
+    assert 0.18 <= asyncio.run(main()) < 1.0
@@ -0,0 +1,72 @@
+# UDP 探测的三种结果：本地应答端（open）、未绑定端口（ICMP 端口不可达 → closed）、只收不答的端口（open|filtered）
+import time, socket, asyncio
+import pytest
+
+class Echo(asyncio.DatagramProtocol):
+    def connection_made(self, transport): self.transport = transport
+    def datagram_received(self, data, addr): self.transport.sendto(b"ok:" + data[:8], addr)
+
+def free_port(host):
+    s = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_DGRAM); s.bind((host, 0))
+    port = s.getsockname()[1]; s.close()
+    return port
+
+def probe(fw, port, host="127.0.0.1", timeout=1.0, responder=False):
+    async def main():
+        transport = None
+        if responder:
+            transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(Echo, local_addr=(host, port))
+        try:
+            t0 = time.monotonic(); res = await fw.udp_probe(host, port, timeout)
+            return res, time.monotonic() - t0
+        finally:
+            if transport: transport.close()
+    return asyncio.run(main())
+
+def test_open_on_reply(fw):
+    res, dt = probe(fw, free_port("127.0.0.1"), responder=True)
+    assert res["status"] == "open" and res["reply_bytes"] > 0
+    assert dt < 0.5  # 收到应答立即返回
+
+@pytest.mark.parametrize("host", ["127.0.0.1", "::1"])
+def test_closed_on_port_unreachable(fw, host):
+    try: port = free_port(host)
+    except OSError: pytest.skip("no IPv6 loopback")
+    res, dt = probe(fw, port, host)
+    assert res["status"] == "closed" and dt < 0.5
+
+def test_open_filtered_on_silence(fw):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.bind(("127.0.0.1", 0)); s.setblocking(False)
+    try:
+        res, dt = probe(fw, s.getsockname()[1], timeout=0.4)
+        assert res["status"] == "open|filtered" and 0.35 <= dt < 1.0
+        # 超时过半后重发一次
+        got = 0
+        while True:
+            try: s.recv(64); got += 1
+            except BlockingIOError: break
+        assert got == 2
+    finally:
+        s.close()
+
+def test_service_payload_sent(fw):
+    # 有协议载荷的端口发送对应请求而不是空数据报
+    port = 53
+    seen = []
+    class Rec(asyncio.DatagramProtocol):
+        def connection_made(self, t): self.t = t
+        def datagram_received(self, data, addr): seen.append(data); self.t.sendto(b"x", addr)
+    async def main():
+        try: transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(Rec, local_addr=("127.0.0.2", port))
+        except OSError: pytest.skip("cannot bind udp/53")
+        try: return await fw.udp_probe("127.0.0.2", port, 1.0)
+        finally: transport.close()
+    res = asyncio.run(main())
+    assert res["status"] == "open" and res["service"] == "dns"
+    assert seen == [fw.UDP_PAYLOADS[53][1]]
+
+def test_udp_common_ports(fw):
+    hosts, mode, ports, timeout, conc = fw.scan_params({"hosts": ["127.0.0.1"], "mode": "udp", "ports": "common"})
+    assert 67 not in ports and 68 not in ports
+    assert {53, 123, 161, 1900} <= set(ports)
+    assert 68 in fw.scan_params({"hosts": ["127.0.0.1"], "mode": "tcp"})[2]